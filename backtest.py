@@ -0,0 +1,198 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from functools import partial
+import models
+from models import Repository, Token, getTimeFrameLabel, HISTORY_RETENTION_SECONDS
+from persistence import createEngine
+from price_history import PriceHistory, fromEpoch, toEpoch, parseDateTime
+from state import MemoryStateBackend
+
+# Replays token_prices through the live alert evaluation (Token.evaluatePriceEntry) with the clock set to the
+# time of each tick and counts the alerts instead of sending them. Symbols are independent, each one is
+# streamed in time order from the (token_id, ts) index and they can be spread over processes:
+#   python backtest.py --days 30 --workers 8 --thresholds 5m=1,1.5,2 1h=3,4,5 --output alerts.csv
+# An alert that fires at threshold t also fires at every lower one, so all candidate thresholds of a timeframe
+# are counted in one pass evaluated at the lowest of them.
+
+# Per process, see setUpEvaluation
+REPOSITORY = None
+# Timeframe label -> candidate thresholds in %, ascending
+CANDIDATES = {}
+# (symbol, timeframe, threshold, direction) -> alerts, price level alerts have timeframe "price_level"
+ALERT_COUNTS = Counter()
+SIMULATED_TS = 0
+
+
+def getSimulatedTime():
+    return fromEpoch(SIMULATED_TS)
+
+
+def recordAlert(notification_dict: {}):
+    # Stands in for models.sendNotification
+    _, notification_type, extra = notification_dict.values()
+    if notification_type == "price_level":
+        ALERT_COUNTS[(extra["symbol"], "price_level", "", extra["event"])] += 1
+        return
+    direction = "up" if extra["went_up"] else "down"
+    for threshold in CANDIDATES[extra["time_frame"]]:
+        if extra["price_change"] < threshold:
+            break
+        ALERT_COUNTS[(extra["symbol"], extra["time_frame"], threshold, direction)] += 1
+
+
+def parseThresholds(values):
+    # ["5m=1,1.5", "1H=3"] -> {label: [thresholds]}, timeframes not given keep their configured threshold
+    candidates = {getTimeFrameLabel(time_frame): [threshold] for time_frame, threshold in models.ALERT_TIMEFRAMES}
+    for value in values:
+        label, _, thresholds = value.partition("=")
+        label = label.strip().lower()
+        if label not in candidates or not thresholds:
+            raise ValueError(f"Expected one of {', '.join(candidates)} as timeframe=threshold,..., got {value}")
+        candidates[label] = sorted(float(threshold) for threshold in thresholds.split(","))
+    return candidates
+
+
+def setUpEvaluation(db_path: str, candidates: dict):
+    # Local in-memory history, simulated clock, alerts counted instead of sent
+    global REPOSITORY, CANDIDATES
+    CANDIDATES = candidates
+    models.SHARED_STATE = None
+    models.PRICE_LEVEL_ALERTS.state = MemoryStateBackend(HISTORY_RETENTION_SECONDS)
+    models.SWEEP = None
+    models.CLOCK = getSimulatedTime
+    models.sendNotification = recordAlert
+    models.ALERT_TIMEFRAMES = [(time_frame, candidates[getTimeFrameLabel(time_frame)][0])
+                               for time_frame, _ in models.ALERT_TIMEFRAMES]
+    REPOSITORY = Repository()
+    REPOSITORY.engine = createEngine(db_path)
+
+
+def streamPrices(engine, token_id: int, since_ts: int, until_ts: int, chunk_size: int):
+    # (ts, price) of one token in [since_ts, until_ts), chunk_size rows per query
+    last = (since_ts - 1, 2 ** 63 - 1)
+    while True:
+        with engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                "SELECT ts, id, price FROM token_prices WHERE token_id = ? AND (ts, id) > (?, ?) AND ts < ? "
+                "ORDER BY ts, id LIMIT ?", (token_id, last[0], last[1], until_ts, chunk_size)).fetchall()
+        for ts, _, price in rows:
+            yield ts, price
+        if len(rows) < chunk_size:
+            return
+        last = (rows[-1][0], rows[-1][1])
+
+
+def replaySymbol(task):
+    # -> (symbol, replayed ticks, alert counts)
+    global SIMULATED_TS
+    token_id, symbol, since_ts, until_ts, chunk_size = task
+    token = Token(symbol=symbol)
+    token.id = token_id
+    token.price_history = PriceHistory()
+    token.candle_loader = partial(REPOSITORY.loadCandleStats, token_id)
+    ticks = 0
+    ALERT_COUNTS.clear()
+    # checkIfPriceChanged prints drops that are not a new low
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for ts, price in streamPrices(REPOSITORY.engine, token_id, since_ts - HISTORY_RETENTION_SECONDS, until_ts,
+                                      chunk_size):
+            if ts < since_ts:
+                # Warm-up, the windows of the first replayed ticks need the history before them
+                token.addToPriceHistory(ts, price)
+                continue
+            SIMULATED_TS = ts
+            ticks += 1
+            if token.getCurrentPrice() == price:
+                continue
+            token.evaluatePriceEntry(price, fromEpoch(ts), ts)
+    return symbol, ticks, Counter(ALERT_COUNTS)
+
+
+def getTimeRange(engine, token_ids, since, until, days: int):
+    if until is not None:
+        until_ts = toEpoch(parseDateTime(until))
+    else:
+        # Newest tick, one index lookup per token
+        with engine.connect() as connection:
+            until_ts = max((connection.exec_driver_sql("SELECT MAX(ts) FROM token_prices WHERE token_id = ?",
+                                                       (token_id,)).scalar() or 0 for token_id in token_ids),
+                           default=0) + 1
+    since_ts = toEpoch(parseDateTime(since)) if since is not None else until_ts - days * 86400
+    return since_ts, until_ts
+
+
+def writeCounts(path: str, counts: Counter):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["symbol", "timeframe", "threshold", "direction", "alerts"])
+        for (symbol, timeframe, threshold, direction), alerts in sorted(counts.items(), key=str):
+            writer.writerow([symbol, timeframe, threshold, direction, alerts])
+
+
+def printSummary(counts: Counter, days: float):
+    totals = Counter()
+    for (_, timeframe, threshold, direction), alerts in counts.items():
+        totals[(timeframe, threshold, direction)] += alerts
+    print(f"{'timeframe':>12} {'threshold':>9} {'direction':>12} {'alerts':>8} {'per day':>9}")
+    for (timeframe, threshold, direction), alerts in sorted(totals.items(), key=str):
+        print(f"{timeframe:>12} {threshold:>9} {direction:>12} {alerts:>8} {alerts / days:>9.1f}")
+
+
+def runBacktest(args, candidates: dict):
+    engine = createEngine(args.db)
+    with engine.connect() as connection:
+        tokens = connection.exec_driver_sql("SELECT id, symbol FROM tokens ORDER BY id").fetchall()
+    if args.symbols:
+        symbols = set(args.symbols)
+        tokens = [(token_id, symbol) for token_id, symbol in tokens if symbol in symbols]
+    since_ts, until_ts = getTimeRange(engine, [token_id for token_id, _ in tokens], args.since, args.until, args.days)
+    print(f"Replaying {len(tokens)} symbols from {fromEpoch(since_ts)} to {fromEpoch(until_ts)} "
+          f"with {args.workers} worker(s)")
+    tasks = [(token_id, str(symbol), since_ts, until_ts, args.chunk_size) for token_id, symbol in tokens]
+    counts = Counter()
+    total_ticks = 0
+    time_start = time.perf_counter()
+
+    def collect(results):
+        nonlocal total_ticks
+        for done, (symbol, ticks, symbol_counts) in enumerate(results, 1):
+            total_ticks += ticks
+            counts.update(symbol_counts)
+            print(f"[{done}/{len(tasks)}] {symbol}: {ticks} ticks, {sum(symbol_counts.values())} alerts, "
+                  f"{total_ticks / (time.perf_counter() - time_start):.0f} ticks/s")
+
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=setUpEvaluation, initargs=(args.db, candidates)) as pool:
+            collect(pool.imap_unordered(replaySymbol, tasks))
+    else:
+        setUpEvaluation(args.db, candidates)
+        collect(map(replaySymbol, tasks))
+    print(f"Replayed {total_ticks} ticks in {time.perf_counter() - time_start:.1f}s")
+    writeCounts(args.output, counts)
+    printSummary(counts, max(1.0, (until_ts - since_ts) / 86400))
+    print(f"Alert counts per symbol written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay token_prices through the alert rules and count alerts")
+    parser.add_argument("--db", default="database.db")
+    parser.add_argument("--since", help="start of the replay (default: --days before --until)")
+    parser.add_argument("--until", help="end of the replay (default: the newest tick)")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--symbols", nargs="*", help="only these symbols")
+    parser.add_argument("--thresholds", nargs="*", default=[],
+                        help="candidate thresholds in %% per timeframe, e.g. 5m=1,1.5,2 1h=3,4")
+    parser.add_argument("--workers", type=int, default=1, help="processes, symbols are spread over them")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="rows per query")
+    parser.add_argument("--output", default="backtest_alerts.csv")
+    args = parser.parse_args()
+    try:
+        candidates = parseThresholds(args.thresholds)
+    except ValueError as e:
+        parser.error(str(e))
+    runBacktest(args, candidates)
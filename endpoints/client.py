@@ -1,20 +1,175 @@
+import asyncio
+from urllib.parse import urlsplit
+import aiohttp
 import requests
 
 
+class EndpointError(Exception):
+    def __init__(self, url: str, message: str, status: int = None):
+        super().__init__(f"{url}: {message}")
+        self.url = url
+        self.status = status
+
+
+class EndpointUnavailable(EndpointError):
+    # Connection refused, timeout, ... the grabber may be down
+    pass
+
+
+class EndpointResponseError(EndpointError):
+    # The grabber answered, but with an error status or a body we can't read
+    pass
+
+
+def parseTokenList(data) -> set:
+    # /getTokens answers with a list of symbols (or of {"symbol": ...} objects)
+    if isinstance(data, dict):
+        data = data.get("tokens", data.keys())
+    return {str(item["symbol"] if isinstance(item, dict) else item) for item in data}
+
+
 class Endpoint:
-    def __init__(self):
-        self.protocol: str = "http"
-        self.port: int = 80
-        self.url = ""
+    # Blocking client for one grabber, all calls share one keep-alive requests.Session.
+    # Grabbers without the bulk routes (/putTokens, /deleteTokens) get one call per symbol.
+    def __init__(self, url: str = "", port: int = 80, protocol: str = "http", timeout: float = 10.0):
+        self.protocol: str = protocol
+        self.port: int = port
+        self.url = url
+        self.timeout = timeout
+        self.session = None
+        self.supports_bulk = None
+
+    @classmethod
+    def fromURL(cls, base_url: str, **kwargs):
+        parts = urlsplit(base_url)
+        return cls(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80), parts.scheme, **kwargs)
 
-    def getTokens(self):
-        resp = requests.get(f"{self.protocol}://{self.url}:{self.port}/getTokens")
-        return resp.json()
+    @property
+    def base_url(self) -> str:
+        return f"{self.protocol}://{self.url}:{self.port}"
+
+    def request(self, method: str, path: str, **kwargs):
+        if self.session is None:
+            self.session = requests.Session()
+        try:
+            resp = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise EndpointUnavailable(self.base_url, str(e))
+        if resp.status_code >= 400:
+            raise EndpointResponseError(self.base_url, f"{method} {path} returned {resp.status_code}",
+                                        resp.status_code)
+        try:
+            return resp.json()
+        except ValueError:
+            raise EndpointResponseError(self.base_url, f"{method} {path} returned invalid JSON", resp.status_code)
+
+    def getTokens(self) -> set:
+        try:
+            return parseTokenList(self.request("GET", "/getTokens"))
+        except (TypeError, KeyError):
+            raise EndpointResponseError(self.base_url, "unexpected /getTokens answer")
 
     def addToken(self, token_symbol):
-        resp = requests.put(f"{self.protocol}://{self.url}:{self.port}/putToken/{token_symbol}")
-        return resp.json()
+        return self.request("PUT", f"/putToken/{token_symbol}")
 
     def removeToken(self, token_symbol):
-        resp = requests.delete(f"{self.protocol}://{self.url}:{self.port}/deleteToken/{token_symbol}")
-        return resp.json()
+        return self.request("DELETE", f"/deleteToken/{token_symbol}")
+
+    def sendBulk(self, method: str, bulk_path: str, single_call, token_symbols) -> list:
+        # -> symbols that could not be sent
+        token_symbols = list(token_symbols)
+        if not token_symbols:
+            return []
+        if self.supports_bulk is not False:
+            try:
+                self.request(method, bulk_path, json=token_symbols)
+                self.supports_bulk = True
+                return []
+            except EndpointResponseError as e:
+                if e.status not in (404, 405):
+                    raise
+                self.supports_bulk = False
+        failed = []
+        for token_symbol in token_symbols:
+            try:
+                single_call(token_symbol)
+            except EndpointResponseError:
+                failed.append(token_symbol)
+        return failed
+
+    def addTokens(self, token_symbols) -> list:
+        return self.sendBulk("PUT", "/putTokens", self.addToken, token_symbols)
+
+    def removeTokens(self, token_symbols) -> list:
+        return self.sendBulk("DELETE", "/deleteTokens", self.removeToken, token_symbols)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class AsyncEndpoint:
+    # asyncio client for one grabber. The aiohttp session (connection pool) and the semaphore limiting
+    # concurrent requests are passed in, so every grabber of the coordinator shares them.
+    def __init__(self, base_url: str, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore = None):
+        self.base_url = base_url.rstrip("/")
+        self.session = session
+        self.semaphore = semaphore or asyncio.Semaphore(32)
+        self.supports_bulk = None
+
+    async def request(self, method: str, path: str, **kwargs):
+        async with self.semaphore:
+            try:
+                async with self.session.request(method, self.base_url + path, **kwargs) as resp:
+                    if resp.status >= 400:
+                        raise EndpointResponseError(self.base_url, f"{method} {path} returned {resp.status}",
+                                                    resp.status)
+                    try:
+                        return await resp.json(content_type=None)
+                    except ValueError:
+                        raise EndpointResponseError(self.base_url, f"{method} {path} returned invalid JSON",
+                                                    resp.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise EndpointUnavailable(self.base_url, str(e) or type(e).__name__)
+
+    async def getTokens(self) -> set:
+        try:
+            return parseTokenList(await self.request("GET", "/getTokens"))
+        except (TypeError, KeyError):
+            raise EndpointResponseError(self.base_url, "unexpected /getTokens answer")
+
+    async def addToken(self, token_symbol):
+        return await self.request("PUT", f"/putToken/{token_symbol}")
+
+    async def removeToken(self, token_symbol):
+        return await self.request("DELETE", f"/deleteToken/{token_symbol}")
+
+    async def sendBulk(self, method: str, bulk_path: str, single_call, token_symbols) -> list:
+        # -> symbols that could not be sent
+        token_symbols = list(token_symbols)
+        if not token_symbols:
+            return []
+        if self.supports_bulk is not False:
+            try:
+                await self.request(method, bulk_path, json=token_symbols)
+                self.supports_bulk = True
+                return []
+            except EndpointResponseError as e:
+                if e.status not in (404, 405):
+                    raise
+                self.supports_bulk = False
+        results = await asyncio.gather(*(single_call(token_symbol) for token_symbol in token_symbols),
+                                       return_exceptions=True)
+        for result in results:
+            # A grabber going down halfway is reported like a failed getTokens
+            if isinstance(result, EndpointUnavailable):
+                raise result
+        return [token_symbol for token_symbol, result in zip(token_symbols, results)
+                if isinstance(result, Exception)]
+
+    async def addTokens(self, token_symbols) -> list:
+        return await self.sendBulk("PUT", "/putTokens", self.addToken, token_symbols)
+
+    async def removeTokens(self, token_symbols) -> list:
+        return await self.sendBulk("DELETE", "/deleteTokens", self.removeToken, token_symbols)
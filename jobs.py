@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import zlib
+import redis
+from decouple import config
+from rq import Queue, SimpleWorker
+from models import Repository, NOTIFICATIONS, ALERTS, REDIS_URL
+from price_history import fromEpoch
+
+# Alert evaluation on RQ workers (EVALUATION_MODE=rq in main.py). Ticks are partitioned into
+# EVALUATION_QUEUES queues by symbol and every queue is served by exactly one worker, so the ticks of a
+# symbol are evaluated in order and its history can stay in that worker's memory:
+#   python jobs.py          one worker process per queue
+#   python jobs.py 0 1      one worker for queues 0 and 1
+
+EVALUATION_QUEUES = config("EVALUATION_QUEUES", default=4, cast=int)
+EVALUATION_JOB_TIMEOUT = config("EVALUATION_JOB_TIMEOUT", default=60, cast=int)
+
+# Per worker process, see getRepository
+REPOSITORY = None
+# Symbols this worker evaluated a tick of
+EVALUATED_SYMBOLS = set()
+
+
+def getQueueName(partition: int) -> str:
+    return f"evaluation-{partition}"
+
+
+def getPartition(symbol: str) -> int:
+    # crc32 instead of hash(), it has to be the same in every process
+    return zlib.crc32(symbol.encode()) % EVALUATION_QUEUES
+
+
+def getRepository() -> Repository:
+    global REPOSITORY
+    if REPOSITORY is None:
+        REPOSITORY = Repository()
+        REPOSITORY.initializeDB(background_jobs=False)
+    return REPOSITORY
+
+
+def evaluateTick(symbol: str, price: float, ts: int):
+    token, _ = getRepository().getOrCreateToken(symbol)
+    if symbol not in EVALUATED_SYMBOLS:
+        # The history read from the database can already have this tick and the ones queued after it
+        EVALUATED_SYMBOLS.add(symbol)
+        token.getPriceHistory().trimFrom(ts)
+        token.window_trackers = None
+    if token.getCurrentPrice() == price:
+        return
+    token.evaluatePriceEntry(price, fromEpoch(ts), ts)
+
+
+class EvaluationQueues:
+    # Ingest side, the ticks of one request are enqueued in a single round trip
+    def __init__(self, connection):
+        self.connection = connection
+        self.queues = [Queue(getQueueName(partition), connection=connection)
+                       for partition in range(EVALUATION_QUEUES)]
+
+    def enqueue(self, ticks):
+        # ticks: iterable of (symbol, price, ts), in the order they have to be evaluated
+        jobs_by_queue = {}
+        for symbol, price, ts in ticks:
+            queue = self.queues[getPartition(symbol)]
+            jobs_by_queue.setdefault(queue, []).append(
+                Queue.prepare_data(evaluateTick, (symbol, price, ts), timeout=EVALUATION_JOB_TIMEOUT,
+                                   result_ttl=0))
+        if not jobs_by_queue:
+            return
+        with self.connection.pipeline() as pipeline:
+            for queue, job_datas in jobs_by_queue.items():
+                queue.enqueue_many(job_datas, pipeline=pipeline)
+            pipeline.execute()
+
+
+def startNotifications():
+    # The dispatcher and the aggregator need an event loop, jobs run on the worker's main thread and hand
+    # their alerts over to this one
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="notifications", daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(NOTIFICATIONS.start(), loop).result()
+    asyncio.run_coroutine_threadsafe(ALERTS.start(), loop).result()
+    return loop, thread
+
+
+def stopNotifications(loop, thread):
+    # Pending alerts are flushed and the queued messages sent
+    asyncio.run_coroutine_threadsafe(ALERTS.stop(), loop).result()
+    asyncio.run_coroutine_threadsafe(NOTIFICATIONS.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def runWorker(partitions):
+    # SimpleWorker runs jobs in its own process instead of forking one per job, so the loaded history and
+    # the window trackers survive from one tick to the next
+    connection = redis.from_url(REDIS_URL)
+    queues = [Queue(getQueueName(partition), connection=connection) for partition in partitions]
+    for token in getRepository().tokens:
+        if getPartition(str(token.symbol)) not in partitions:
+            # Another worker's symbol
+            token.price_history = None
+            token.window_trackers = None
+    loop, thread = startNotifications()
+    try:
+        SimpleWorker(queues, connection=connection).work()
+    finally:
+        stopNotifications(loop, thread)
+
+
+if __name__ == "__main__":
+    # Jobs are enqueued as jobs.evaluateTick and RQ imports them from the module "jobs". Run as a script this
+    # file is "__main__", a second copy with its own REPOSITORY, so everything is run from the imported one.
+    import jobs
+
+    parser = argparse.ArgumentParser(description="Alert evaluation workers")
+    parser.add_argument("partitions", type=int, nargs="*", help=f"queues to serve, 0-{EVALUATION_QUEUES - 1}")
+    args = parser.parse_args()
+    if args.partitions:
+        jobs.runWorker(args.partitions)
+    else:
+        workers = [multiprocessing.Process(target=jobs.runWorker, args=([partition],))
+                   for partition in range(EVALUATION_QUEUES)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
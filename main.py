@@ -1,91 +1,368 @@
 import asyncio
+import hmac
+import random
+import time
 import orjson as json
-import multiprocessing
+from collections import Counter
 from datetime import datetime
-from multiprocessing import Process
+import aiohttp
 import redis
-import requests
 import uvicorn
-from decouple import config
-from fastapi import FastAPI, Request
-from models import Repository
-from redis_test_1 import count_words_at_url
-from redis import Redis
-from rq import Queue
+from decouple import config, Csv
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request, Response
+from endpoints.client import AsyncEndpoint, EndpointError
+from jobs import EvaluationQueues, getQueueName
+from metrics import REGISTRY, STAGE_SECONDS, TICKS, REJECTED_TICKS, Gauge, CallbackCounter, logSampled
+from models import Repository, NOTIFICATIONS, ALERTS, REDIS_URL, STATE_BACKEND, SWEEP, SWEEP_INTERVAL_SECONDS
+from price_history import parseDateTime, toEpoch
+from profiling import Profiler, MemoryTracer
+from sharding import ShardManager
 
 
 PORT_TO_RUN_UVICORN = int(config("PORT_TO_RUN_UVICORN"))
 
 
-async def startPollingEndpoints(_endpoints):
-    while True:
-        for endpoint in _endpoints:
-            for token_in_endpoint in endpoint["tokens"]:
-                try:
-                    requests.put(endpoint["url"] + token_in_endpoint)
-                    # print("Connected to endpoint: " + endpoint["url"])
-                except:
-                    x = ""
-        await asyncio.sleep(120)
+POLLING_INTERVAL_SECONDS = config("POLLING_INTERVAL_SECONDS", default=120.0, cast=float)
+POLLING_CONCURRENCY = config("POLLING_CONCURRENCY", default=32, cast=int)
+POLLING_TIMEOUT_SECONDS = config("POLLING_TIMEOUT_SECONDS", default=10.0, cast=float)
+# Symbols from coins.json are sharded across these, e.g. http://frog01.mikr.us:21591,http://95.217.89.204:3118
+GRABBER_URLS = config("GRABBER_URLS", default="http://frog01.mikr.us:21591", cast=Csv())
+# Every worker polling would fetch each symbol once per worker. With STATE_BACKEND=redis polling is off unless
+# set, turn it on for one primary worker only, the others just serve the ingest endpoints.
+POLLING_ENABLED = config("POLLING_ENABLED", default=STATE_BACKEND != "redis", cast=bool)
+# "inline": alerts are evaluated in the request. "rq": the request only stores the tick and enqueues its
+# evaluation for the workers of jobs.py. "sweep": timeframes are evaluated for all tokens at once, see sweep.py
+EVALUATION_MODE = config("EVALUATION_MODE", default="inline")
+EVALUATION = None
+# The /admin routes are off unless this is set, requests need it in the X-Admin-Token header
+ADMIN_TOKEN = config("ADMIN_TOKEN", default="")
+PROFILER = Profiler()
+MEMORY_TRACER = MemoryTracer()
+
+# url -> failed requests since start
+endpoint_errors = Counter()
+
+
+async def fetchEndpointTokens(endpoint: AsyncEndpoint, shards: ShardManager):
+    # Doubles as the health check of the grabber, the answer time is its load for the sharding
+    time_start = time.perf_counter()
+    try:
+        tokens = await endpoint.getTokens()
+    except EndpointError as e:
+        print(f"Could not get tokens: {e}")
+        shards.reportFailure(endpoint.base_url)
+        return endpoint.base_url, None
+    shards.reportSuccess(endpoint.base_url, time.perf_counter() - time_start)
+    return endpoint.base_url, tokens
+
+
+async def reconcileEndpoint(endpoint: AsyncEndpoint, current: set, desired: set, cycle_errors: Counter,
+                            cycle_changes: Counter):
+    # Only the difference between what the grabber has and what it should have is sent
+    url = endpoint.base_url
+    to_add = desired - current
+    to_remove = current - desired
+    cycle_changes[url] += len(to_add) + len(to_remove)
+    try:
+        failed_adds, failed_removes = await asyncio.gather(endpoint.addTokens(to_add),
+                                                           endpoint.removeTokens(to_remove))
+    except EndpointError as e:
+        print(f"Could not update tokens: {e}")
+        cycle_errors[url] += 1
+        return
+    cycle_errors[url] += len(failed_adds) + len(failed_removes)
 
 
-def setup_endpoints(_endpoints: list):
+async def pollEndpoints(endpoints: dict, shards: ShardManager, symbols: list):
+    cycle_errors = Counter()
+    cycle_changes = Counter()
+    # Health and current tokens of every grabber first, so a dead grabber's symbols move this cycle
+    results = await asyncio.gather(*(fetchEndpointTokens(endpoint, shards) for endpoint in endpoints.values()))
+    current_tokens = {url: tokens for url, tokens in results if tokens is not None}
+    for url, tokens in results:
+        if tokens is None:
+            cycle_errors[url] += 1
+    assignment = shards.assign(symbols)
+    if not assignment:
+        print("No grabber is reachable")
+    # A grabber that failed this check can still be assigned until it reaches max_failures, its tokens are
+    # unknown so it is left as it is until the next cycle
+    await asyncio.gather(*(reconcileEndpoint(endpoints[url], current_tokens[url], desired, cycle_errors,
+                                             cycle_changes)
+                           for url, desired in assignment.items() if url in current_tokens))
+    for url, changes in cycle_changes.items():
+        if changes:
+            print(f"Reconciled {url}: {changes} tokens added/removed, {len(assignment[url])} assigned")
+    for url, errors in cycle_errors.items():
+        if not errors:
+            continue
+        endpoint_errors[url] += errors
+        print(f"{errors} requests to {url} failed ({endpoint_errors[url]} since start)")
+
+
+async def startPollingEndpoints(shards: ShardManager, symbols: list):
+    semaphore = asyncio.Semaphore(POLLING_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=POLLING_CONCURRENCY, keepalive_timeout=POLLING_INTERVAL_SECONDS * 2)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=POLLING_TIMEOUT_SECONDS)) as session:
+        endpoints = {url: AsyncEndpoint(url, session, semaphore) for url in shards.urls}
+        while True:
+            try:
+                await pollEndpoints(endpoints, shards, symbols)
+            except Exception as e:
+                # One bad cycle must not stop the polling for the life of the process
+                print(f"Polling cycle failed: {e!r}")
+            # Jitter so several coordinators/grabbers don't end up in lockstep
+            await asyncio.sleep(POLLING_INTERVAL_SECONDS * random.uniform(0.9, 1.1))
+
+
+def setup_endpoints():
     coins_to_check = json.loads(open("coins.json", "r").read())
+    symbols = [coin_from_file["symbol"] for coin_from_file in coins_to_check]
+    return ShardManager([url.rstrip("/") for url in GRABBER_URLS]), symbols
+
 
-    def split_list(data, n: int):
-        # Calculate the length of each sublist
-        sublist_length = len(data) // n
-        # Split the list into 'n' sublists
-        sublists = [data[i * sublist_length: (i + 1) * sublist_length] for i in range(n)]
-        return sublists
+async def sweepPeriodically():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        try:
+            with STAGE_SECONDS.time("sweep"):
+                repo.runSweep(toEpoch(datetime.now()))
+        except Exception as e:
+            print(f"Sweep failed: {e}")
+
+
+def registerGauges():
+    # Read at scrape time from the state of this process
+    REGISTRY.register(Gauge("coordinator_tokens", "Tokens known to the coordinator",
+                            function=lambda: len(repo.tokens)))
+    REGISTRY.register(Gauge("coordinator_history_entries", "Price entries held in memory for alert evaluation",
+                            function=lambda: sum(len(token.price_history) for token in list(repo.tokens)
+                                                 if token.price_history is not None)))
+    REGISTRY.register(Gauge("coordinator_pending", "Items waiting in an in-process queue", labels=("queue",),
+                            function=lambda: {
+                                ("price_writer",): len(repo.price_writer.buffer),
+                                ("notifications",): NOTIFICATIONS.queue.qsize() if NOTIFICATIONS.queue else 0,
+                                ("alerts",): sum(len(alerts) for alerts in ALERTS.pending.values())}))
+    REGISTRY.register(CallbackCounter("coordinator_price_rows_total", "Price rows by write-behind outcome",
+                                      labels=("outcome",),
+                                      function=lambda: {(key,): value
+                                                        for key, value in repo.price_writer.stats.items()}))
+    REGISTRY.register(CallbackCounter("coordinator_notifications_total", "Webhook posts by outcome",
+                                      labels=("outcome",),
+                                      function=lambda: {(key,): value for key, value in NOTIFICATIONS.stats.items()}))
+    REGISTRY.register(CallbackCounter("coordinator_aggregated_alerts_total", "Alerts through the aggregator",
+                                      labels=("outcome",),
+                                      function=lambda: {(key,): value for key, value in ALERTS.stats.items()}))
+    if EVALUATION is not None:
+        REGISTRY.register(Gauge("coordinator_evaluation_queue_jobs", "Ticks waiting for an evaluation worker",
+                                labels=("queue",),
+                                function=lambda: {(getQueueName(partition),): len(queue)
+                                                  for partition, queue in enumerate(EVALUATION.queues)}))
 
-    # Split the data into 2 similar length lists
-   # n = 1
-    #sublists = split_list(coins_to_check, n)
 
-    # Print the sublists
-    #for i, sublist in enumerate(sublists):
-        #print(f"Sublist {i + 1}: {sublist}")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    registerGauges()
+    await NOTIFICATIONS.start()
+    await ALERTS.start()
+    background_tasks = []
+    if POLLING_ENABLED:
+        # Runs on the uvicorn event loop, the grabber I/O is all async
+        shards, symbols = setup_endpoints()
+        background_tasks.append(asyncio.create_task(startPollingEndpoints(shards, symbols)))
+    if SWEEP is not None:
+        background_tasks.append(asyncio.create_task(sweepPeriodically()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    PROFILER.stop()
+    await ALERTS.stop()
+    await NOTIFICATIONS.stop()
+    repo.rollups.stop()
+    repo.price_writer.stop()
 
-    #urls = ["http://frog01.mikr.us:21591/putToken/", "http://95.217.89.204:3118/putToken/"]
-    urls = ["http://frog01.mikr.us:21591/putToken/"]
-    #urls = ["http://95.217.89.204:3118/putToken/"]
-    #for i, url in enumerate(urls):
 
-    _endpoints.append({"url": urls[0], "tokens": [coin_from_file["symbol"] for coin_from_file in coins_to_check]})
-    asyncio.run(startPollingEndpoints(_endpoints))
+app = FastAPI(lifespan=lifespan)
 
 
-app = FastAPI()
+@app.get("/metrics")
+async def getMetrics():
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/addTokenPrice")
 async def addTokenToCheck(request: Request):
-    json_data = await request.json()
-    print(json_data)
+    TICKS.inc("addTokenPrice")
+    body = await request.body()
+    if PROFILER.session is not None:
+        return PROFILER.run(ingestTick, body)
+    return ingestTick(body)
+
+
+def ingestTick(body: bytes):
+    time_start = time.perf_counter()
+    json_data = json.loads(body)
     # {'coin_name': 'LINA', 'current_price': 0.011833, 'current_time': '2024-03-01 16:57:42'}
     symbol = str(json_data["symbol"])
     current_price = float(json_data["current_price"])
-    current_time = datetime.strptime(str(json_data["current_time"]), "%Y-%m-%d %H:%M:%S")
-    token_found, _ = repo.findToken(symbol)
-    if token_found is None:
-        token_found = repo.addNewToken(symbol)
-        print(f"Added new token: {symbol}, current price: {current_time} at {current_time}")
-    token_found.addPriceEntry(current_price, current_time, repo.session)
+    current_time = parseDateTime(json_data["current_time"])
+    STAGE_SECONDS.observe(time.perf_counter() - time_start, "parse")
+    logSampled("tick", symbol=symbol, price=current_price, time=current_time)
+    with STAGE_SECONDS.time("token_lookup"):
+        token_found, created = repo.getOrCreateToken(symbol)
+    if created:
+        print(f"Added new token: {symbol}, current price: {current_price} at {current_time}")
+    if EVALUATION is not None:
+        to_evaluate = recordTicks(token_found, [(current_time, current_price)])
+        with STAGE_SECONDS.time("enqueue"):
+            EVALUATION.enqueue(to_evaluate)
+    else:
+        token_found.addPriceEntry(current_price, current_time, repo.price_writer)
     return {"response": "ok"}
 
 
+def recordTicks(token, ticks):
+    # ticks: [(datetime, price)] of one token in time order -> [(symbol, price, ts)] for EVALUATION.enqueue
+    to_evaluate = []
+    for current_time, current_price in ticks:
+        ts = toEpoch(current_time)
+        with STAGE_SECONDS.time("db_write"):
+            repo.price_writer.add({"token_id": token.id, "price": current_price, "ts": ts})
+        to_evaluate.append((str(token.symbol), current_price, ts))
+    return to_evaluate
+
+
+def parseTicks(body: bytes, content_type: str):
+    # JSON array of ticks or NDJSON (one tick per line)
+    if "ndjson" in content_type or not body.lstrip().startswith(b"["):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    return json.loads(body)
+
+
+@app.post("/addTokenPrices")
+async def addTokenPrices(request: Request):
+    # [{"symbol": "LINA", "current_price": 0.011833, "current_time": "2024-03-01 16:57:42"}, ...]
+    body = await request.body()
+    content_type = request.headers.get("content-type", "")
+    if PROFILER.session is not None:
+        return PROFILER.run(ingestTicks, body, content_type)
+    return ingestTicks(body, content_type)
+
+
+def ingestTicks(body: bytes, content_type: str):
+    time_start = time.perf_counter()
+    ticks = parseTicks(body, content_type)
+    ticks_by_symbol = {}
+    rejected = 0
+    for tick in ticks:
+        try:
+            symbol = str(tick["symbol"])
+            parsed_tick = (parseDateTime(tick["current_time"]), float(tick["current_price"]))
+        except (KeyError, TypeError, ValueError):
+            rejected += 1
+            continue
+        ticks_by_symbol.setdefault(symbol, []).append(parsed_tick)
+    STAGE_SECONDS.observe(time.perf_counter() - time_start, "parse")
+    TICKS.inc("addTokenPrices", amount=len(ticks))
+    if rejected:
+        REJECTED_TICKS.inc(amount=rejected)
+    logSampled("ticks", accepted=len(ticks) - rejected, rejected=rejected, symbols=len(ticks_by_symbol))
+    to_evaluate = []
+    for symbol, symbol_ticks in ticks_by_symbol.items():
+        with STAGE_SECONDS.time("token_lookup"):
+            token_found, created = repo.getOrCreateToken(symbol)
+        if created:
+            print(f"Added new token: {symbol}")
+        symbol_ticks.sort(key=lambda tick: tick[0])
+        if EVALUATION is not None:
+            to_evaluate.extend(recordTicks(token_found, symbol_ticks))
+            continue
+        for current_time, current_price in symbol_ticks:
+            token_found.addPriceEntry(current_price, current_time, repo.price_writer)
+    if to_evaluate:
+        with STAGE_SECONDS.time("enqueue"):
+            EVALUATION.enqueue(to_evaluate)
+    return {"response": "ok", "accepted": len(ticks) - rejected, "rejected": rejected}
+
+
+def requireAdmin(x_admin_token: str = Header(default="")):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    if not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+admin = APIRouter(prefix="/admin", dependencies=[Depends(requireAdmin)])
+
+
+@admin.post("/profile")
+async def startProfile(mode: str = "sampling", seconds: float = 30.0, requests: int = 1000,
+                       interval: float = 0.005):
+    # Profiles the next `requests` ingest requests or `seconds`, whichever ends first
+    try:
+        session = PROFILER.start(mode, seconds, requests, interval)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return session.getStatus()
+
+
+@admin.get("/profile")
+async def getProfile(format: str = "text", sort: str = "cumulative", limit: int = 50):
+    # Status while the session runs, then pstats text (cprofile), collapsed stacks (sampling, for
+    # flamegraph.pl / speedscope) or format=pstats for a binary dump
+    session = PROFILER.getLast()
+    if session is None:
+        raise HTTPException(status_code=404, detail="No profiling session")
+    if session.finished is None:
+        return session.getStatus()
+    if format == "pstats":
+        try:
+            return Response(session.getBinary(), media_type="application/octet-stream",
+                            headers={"Content-Disposition": "attachment; filename=coordinator.pstats"})
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return Response(session.getText(sort, limit), media_type="text/plain")
+
+
+@admin.delete("/profile")
+async def stopProfile():
+    session = PROFILER.stop()
+    if session is None:
+        raise HTTPException(status_code=404, detail="No profiling session")
+    return session.getStatus()
+
+
+@admin.get("/memory")
+async def getMemorySnapshot(limit: int = 25, key_type: str = "lineno"):
+    # First call starts tracemalloc, later ones return the top allocations and what grew since the last call
+    if key_type not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="key_type must be lineno, filename or traceback")
+    text = MEMORY_TRACER.snapshot(limit, key_type)
+    histories = sorted(((len(token.price_history), str(token.symbol)) for token in list(repo.tokens)
+                        if token.price_history is not None), reverse=True)[:limit]
+    text += "\nLargest in-memory price histories:\n" + "".join(f"{symbol}: {entries} entries\n"
+                                                              for entries, symbol in histories)
+    return Response(text, media_type="text/plain")
+
+
+@admin.delete("/memory")
+async def stopMemoryTracing():
+    MEMORY_TRACER.stop()
+    return {"response": "ok"}
+
+
+app.include_router(admin)
+
+
 if __name__ == "__main__":
     repo = Repository()
     repo.initializeDB()
-    conn = redis.from_url("redis://localhost:6379")
-
-    #q = Queue(connection=Redis())
-    #q.enqueue(count_words_at_url, args=('http://nvie.com', repo.tokens, set("ee")))
-
-    manager = multiprocessing.Manager()
-    endpoints = manager.list()
-    fetcher_process = Process(target=setup_endpoints, args=(endpoints,))
-    fetcher_process.start()
+    if EVALUATION_MODE == "rq":
+        EVALUATION = EvaluationQueues(redis.from_url(REDIS_URL))
 
     uvicorn.run(app, host="0.0.0.0", port=PORT_TO_RUN_UVICORN, log_level="error")
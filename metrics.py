@@ -0,0 +1,204 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+import orjson as json
+from decouple import config
+
+# Counters, gauges and histograms rendered in the Prometheus text format by GET /metrics. Hot path updates
+# are a perf_counter() call and a dict update under an uncontended lock.
+
+# Fraction of ticks (requests for /addTokenPrices) that get a log line, 0 turns it off
+TICK_LOG_SAMPLE_RATE = config("TICK_LOG_SAMPLE_RATE", default=0.001, cast=float)
+
+# Seconds, 10µs up to 10s
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def formatValue(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def formatLabels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{escapeLabel(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escapeLabel(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def samples(self):
+        # -> [(name suffix, label values, extra label, value)]
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{formatLabels(self.labels, label_values, extra)} "
+                         f"{formatValue(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels=()):
+        super().__init__(name, description, labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [("", label_values, "", value) for label_values, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    # Either set() or a function read at scrape time, returning a value or {label values tuple: value}
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self.values = {}
+        self.function = function
+
+    def set(self, value: float, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                values = dict(self.values)
+        else:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [("", label_values, "", value) for label_values, value in sorted(values.items())]
+
+
+class CallbackCounter(Gauge):
+    # Counter kept elsewhere (e.g. a stats dict), read at scrape time
+    type = "counter"
+
+
+class Timer:
+    __slots__ = ("histogram", "label_values", "time_start")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.time_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.histogram.observe(time.perf_counter() - self.time_start, *self.label_values)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (last one is +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[label_values] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values) -> Timer:
+        return Timer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            values = [(label_values, list(counts), total, count)
+                      for label_values, (counts, total, count) in sorted(self.values.items())]
+        samples = []
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", label_values, f'le="{formatValue(bound)}"', cumulative))
+            samples.append(("_sum", label_values, "", total))
+            samples.append(("_count", label_values, "", count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Registering a name again replaces the metric (e.g. gauges bound to a new Repository)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} failed: {escapeLabel(e)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Stages: parse per request, token_lookup per symbol, db_write, timeframes, shared_state_read and price_levels per
+# tick, enqueue per request (EVALUATION_MODE=rq), sweep per run, notification_send per webhook post
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "coordinator_stage_seconds", "Time spent in each processing stage",
+    labels=("stage",)))
+TIMEFRAME_SECONDS = REGISTRY.register(Histogram(
+    "coordinator_timeframe_evaluation_seconds", "Time to evaluate one alert timeframe of a tick",
+    labels=("timeframe",)))
+DB_FLUSH_SECONDS = REGISTRY.register(Histogram(
+    "coordinator_db_flush_seconds", "Time of one write-behind bulk insert of price rows"))
+TICKS = REGISTRY.register(Counter(
+    "coordinator_ticks_total", "Ticks received", labels=("endpoint",)))
+REJECTED_TICKS = REGISTRY.register(Counter(
+    "coordinator_rejected_ticks_total", "Malformed ticks skipped by /addTokenPrices"))
+DUPLICATE_TICKS = REGISTRY.register(Counter(
+    "coordinator_duplicate_ticks_total", "Ticks dropped because the price did not change"))
+ALERTS_TOTAL = REGISTRY.register(Counter(
+    "coordinator_alerts_total", "Alerts raised before aggregation", labels=("type",)))
+
+
+def logSampled(event: str, **fields):
+    # One JSON line for a TICK_LOG_SAMPLE_RATE fraction of the calls
+    if TICK_LOG_SAMPLE_RATE <= 0 or random.random() >= TICK_LOG_SAMPLE_RATE:
+        return
+    print(json.dumps({"ts": datetime.now().isoformat(timespec="seconds"), "event": event, **fields},
+                     default=str).decode())
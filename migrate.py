@@ -0,0 +1,153 @@
+import argparse
+import sqlite3
+import time
+from sqlalchemy import text
+from persistence import createEngine, ensureSchema
+from price_history import toEpoch, parseDateTime
+
+# Merges duplicate tokens, converts token_prices.datetime strings to epoch seconds in token_prices.ts and
+# builds the (token_id, ts) index by copying into an indexed table. Every chunk is its own short transaction,
+# so the coordinator can keep running (WAL mode).
+#   python migrate.py --db database.db --chunk-size 5000
+
+
+def mergeDuplicateTokens(engine):
+    # Two first-seen ticks racing each other used to create the same symbol twice, keep the oldest row
+    with engine.begin() as connection:
+        duplicates = connection.execute(text(
+            "SELECT symbol, MIN(id), GROUP_CONCAT(id) FROM tokens GROUP BY symbol HAVING COUNT(*) > 1")).fetchall()
+    for symbol, kept_id, ids in duplicates:
+        for duplicate_id in (int(_id) for _id in ids.split(",") if int(_id) != kept_id):
+            with engine.begin() as connection:
+                connection.execute(text("UPDATE token_prices SET token_id = :kept_id WHERE token_id = :duplicate_id"),
+                                   {"kept_id": kept_id, "duplicate_id": duplicate_id})
+                connection.execute(text("DELETE FROM tokens WHERE id = :duplicate_id"), {"duplicate_id": duplicate_id})
+        print(f"Merged duplicates of {symbol} into token {kept_id}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_tokens_symbol ON tokens (symbol)"))
+
+
+def migrateTimestamps(db_path: str, chunk_size: int, pause: float):
+    engine = createEngine(db_path)
+    ensureSchema(engine)
+    mergeDuplicateTokens(engine)
+    last_id = 0
+    converted = 0
+    failed = 0
+    time_start = time.monotonic()
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text("SELECT id, datetime FROM token_prices WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": chunk_size}).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for row_id, value in rows:
+                if value is None:
+                    continue
+                try:
+                    updates.append({"ts": toEpoch(parseDateTime(value)), "id": row_id})
+                except ValueError:
+                    failed += 1
+            if updates:
+                connection.execute(text("UPDATE token_prices SET ts = :ts WHERE id = :id AND ts IS NULL"), updates)
+            converted += len(updates)
+        print(f"Converted {converted} rows (up to id {last_id})", end="\r")
+        if pause:
+            # Let the coordinator's writer in between chunks
+            time.sleep(pause)
+    print(f"\nConverted {converted} rows in {time.monotonic() - time_start:.1f}s, {failed} unparseable")
+
+    buildIndexedTable(engine, chunk_size, pause)
+    print(f"Done in {time.monotonic() - time_start:.1f}s")
+
+
+def getIndexTable(connection, index_name: str):
+    return connection.execute(text("SELECT tbl_name FROM sqlite_master WHERE type = 'index' AND name = :name"),
+                              {"name": index_name}).scalar()
+
+
+def copyChunk(execute, chunk_size: int):
+    # Next rows by id from token_prices into token_prices_new, returns how many were copied. execute is the
+    # exec_driver_sql of a SQLAlchemy connection or execute of a sqlite3 one.
+    last_id = execute("SELECT COALESCE(MAX(id), 0) FROM token_prices_new", ()).fetchone()[0]
+    return execute("INSERT INTO token_prices_new (id, token_id, price, ts, datetime) "
+                   "SELECT id, token_id, price, ts, datetime FROM token_prices WHERE id > ? ORDER BY id LIMIT ?",
+                   (last_id, chunk_size)).rowcount
+
+
+def buildIndexedTable(engine, chunk_size: int, pause: float):
+    # A CREATE INDEX over the whole table would hold the write lock for minutes on a big database. Instead the
+    # rows are copied in chunks into an already indexed token_prices_new, and only the swap of the two tables
+    # (plus the rows written since the last chunk) is one short transaction. Can be interrupted and resumed.
+    with engine.begin() as connection:
+        indexed = getIndexTable(connection, "ix_token_prices_token_id_ts") == "token_prices"
+        old_table = connection.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'token_prices_old'")).scalar()
+    if indexed:
+        print("token_prices already has the (token_id, ts) index")
+        if old_table is not None:
+            # Interrupted after the swap
+            dropOldTable(engine, chunk_size, pause)
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS token_prices_new (token_id INTEGER, price FLOAT, ts INTEGER, "
+            "datetime VARCHAR, id INTEGER NOT NULL PRIMARY KEY, FOREIGN KEY(token_id) REFERENCES tokens (id))"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_token_prices_token_id_ts ON token_prices_new (token_id, ts)"))
+    copied = 0
+    while True:
+        with engine.begin() as connection:
+            count = copyChunk(connection.exec_driver_sql, chunk_size)
+        copied += count
+        print(f"Copied {copied} rows into the indexed table", end="\r")
+        if count < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    print()
+    # Rows the coordinator wrote since the last chunk, then the swap. BEGIN IMMEDIATE takes the write lock
+    # up front, so nothing can be written to the old table after the last copy.
+    connection = sqlite3.connect(engine.url.database, isolation_level=None, timeout=30)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        while copyChunk(connection.execute, chunk_size) == chunk_size:
+            pass
+        connection.execute("ALTER TABLE token_prices RENAME TO token_prices_old")
+        connection.execute("ALTER TABLE token_prices_new RENAME TO token_prices")
+        connection.execute("COMMIT")
+    except Exception:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+    print("Swapped in the indexed token_prices, dropping the old table")
+    dropOldTable(engine, chunk_size, pause)
+
+
+def dropOldTable(engine, chunk_size: int, pause: float):
+    # Emptied in chunks first, dropping a big table in one go would lock for long as well
+    while True:
+        with engine.begin() as connection:
+            deleted = connection.execute(text(
+                "DELETE FROM token_prices_old WHERE id IN (SELECT id FROM token_prices_old LIMIT :limit)"),
+                {"limit": chunk_size}).rowcount
+        if deleted < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE token_prices_old"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate token_prices to integer epoch timestamps")
+    parser.add_argument("--db", default="database.db")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--pause", type=float, default=0.01, help="seconds to sleep between chunks")
+    args = parser.parse_args()
+    migrateTimestamps(args.db, args.chunk_size, args.pause)
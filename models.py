@@ -1,37 +1,29 @@
 import os
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import Set
+from functools import partial
+from typing import Dict, Set
 import orjson as json
 import requests
 from decouple import config
-from sqlalchemy import Column, Integer, ForeignKey, Float, String, create_engine
+from sqlalchemy import Column, Integer, ForeignKey, Float, String, Index
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column, relationship, sessionmaker
+from metrics import STAGE_SECONDS, TIMEFRAME_SECONDS, DUPLICATE_TICKS, ALERTS_TOTAL
+from notifications import NotificationDispatcher, AlertAggregator
+from persistence import PriceWriter, createEngine, ensureSchema
+from price_history import PriceHistory, SlidingWindowExtremes, toEpoch, fromEpoch, parseDateTime, timeFrameToSeconds
+from price_levels import PriceLevelIndex, PriceLevelCrossingDetector
+from rollups import RollupJob
+from state import MemoryStateBackend, createStateBackend
+
+
+PRICE_LEVELS = PriceLevelIndex("price_levels.json")
 
 
 def getPriceLevels(token_to_find: str):
-    price_levels = json.loads(open("price_levels.json", "r").read())
-    for token in price_levels:
-        token_price_levels = [float(token_price_level) for token_price_level in price_levels[token]]
-        if token == token_to_find:
-            return token_price_levels
-    return []
-
-
-def checkIfPriceIsAroundPriceLevel(token_to_find: str, current_price: float, max_change: float = 0.01):
-    # max_change = 1 -> 100%
-    price_levels = getPriceLevels(token_to_find)
-    if len(price_levels) > 0:
-        for price_level in price_levels:
-            if price_level * float(1 - max_change) < current_price < price_level * float(1 + max_change):
-                print(price_level)
-                return {
-                    "result": True,
-                    "price_level": price_level
-                }
-    return {
-        "result": False,
-        "price_level": 0.0
-    }
+    return list(PRICE_LEVELS.getLevels(token_to_find))
 
 
 MINIMUM_PRICE_CHANGE_TO_ALERT_5M = float(config("MINIMUM_PRICE_CHANGE_TO_ALERT_5M"))
@@ -44,9 +36,91 @@ MINIMUM_PRICE_CHANGE_TO_ALERT_24H = float(config("MINIMUM_PRICE_CHANGE_TO_ALERT_
 MINIMUM_PRICE_CHANGE_TO_ALERT_7D = float(config("MINIMUM_PRICE_CHANGE_TO_ALERT_7D"))
 MINIMUM_PRICE_CHANGE_TO_ALERT_30D = float(config("MINIMUM_PRICE_CHANGE_TO_ALERT_30D"))
 
+# (time_frame, minimum change in % to alert), shortest first
+ALERT_TIMEFRAMES = [
+    ({"minutes": 5}, MINIMUM_PRICE_CHANGE_TO_ALERT_5M),
+    ({"minutes": 15}, MINIMUM_PRICE_CHANGE_TO_ALERT_15M),
+    ({"minutes": 30}, MINIMUM_PRICE_CHANGE_TO_ALERT_30M),
+    ({"hours": 1}, MINIMUM_PRICE_CHANGE_TO_ALERT_1H),
+    ({"hours": 4}, MINIMUM_PRICE_CHANGE_TO_ALERT_4H),
+    ({"hours": 8}, MINIMUM_PRICE_CHANGE_TO_ALERT_8H),
+    ({"hours": 24}, MINIMUM_PRICE_CHANGE_TO_ALERT_24H),
+    # ({"days": 7}, MINIMUM_PRICE_CHANGE_TO_ALERT_7D),
+    # ({"days": 30}, MINIMUM_PRICE_CHANGE_TO_ALERT_30D),
+]
+
+
+def getTimeFrameLabel(time_frame: dict) -> str:
+    # {"hours": 4} -> "4h"
+    return "".join(f"{value}{unit[0]}" for unit, value in time_frame.items())
+
+
+# Window length in seconds -> label of its timeframe in /metrics
+TIMEFRAME_LABELS = {timeFrameToSeconds(time_frame): getTimeFrameLabel(time_frame)
+                    for time_frame, _ in ALERT_TIMEFRAMES}
+# "Now" of the alert evaluation, backtest.py replaces it with the time of the replayed tick
+CLOCK = datetime.now
+# How much price history is loaded at startup and kept in memory, longer timeframes are evaluated
+# from the 1h candles
+HISTORY_RETENTION_SECONDS = config("HISTORY_RETENTION_HOURS", default=24, cast=int) * 3600
+
+# "local": history lives in each Token (one worker). "redis": shared by all coordinator workers, so ingest can
+# be spread across processes/nodes. "memory": the shared code path in a single process.
+STATE_BACKEND = config("STATE_BACKEND", default="local")
+REDIS_URL = config("REDIS_URL", default="redis://localhost:6379")
+SHARED_STATE = createStateBackend(STATE_BACKEND, HISTORY_RETENTION_SECONDS, REDIS_URL)
+# Crossing state and cooldowns of the price levels, per process with the local backend
+PRICE_LEVEL_ALERTS = PriceLevelCrossingDetector(
+    PRICE_LEVELS,
+    SHARED_STATE if SHARED_STATE is not None else MemoryStateBackend(HISTORY_RETENTION_SECONDS),
+    band=config("PRICE_LEVEL_BAND", default=0.015, cast=float),
+    hysteresis=config("PRICE_LEVEL_HYSTERESIS", default=0.5, cast=float),
+    cooldown=config("PRICE_LEVEL_COOLDOWN_SECONDS", default=900, cast=int))
+
+
+def createSweepEvaluator():
+    # EVALUATION_MODE=sweep: timeframes of all tokens are evaluated together every SWEEP_INTERVAL_SECONDS
+    # (main.py) instead of on each tick. Longer timeframes than the history retention are left out.
+    if config("EVALUATION_MODE", default="inline") != "sweep":
+        return None
+    from sweep import SweepEvaluator
+    return SweepEvaluator([(time_frame, threshold) for time_frame, threshold in ALERT_TIMEFRAMES
+                           if timeFrameToSeconds(time_frame) <= HISTORY_RETENTION_SECONDS])
+
+
+SWEEP = createSweepEvaluator()
+SWEEP_INTERVAL_SECONDS = config("SWEEP_INTERVAL_SECONDS", default=1.0, cast=float)
+
+# Rollups and retention deletes touch whole tables, with several workers on one database (STATE_BACKEND=redis)
+# they are off unless set, like POLLING_ENABLED turn them on for the primary worker only
+ROLLUPS_ENABLED = config("ROLLUPS_ENABLED", default=STATE_BACKEND != "redis", cast=bool)
+ROLLUP_INTERVAL_SECONDS = config("ROLLUP_INTERVAL_SECONDS", default=60.0, cast=float)
+# 0 keeps everything
+RAW_PRICES_RETENTION_DAYS = config("RAW_PRICES_RETENTION_DAYS", default=0, cast=int)
+CANDLE_RETENTION_DAYS = {
+    60: config("CANDLES_1M_RETENTION_DAYS", default=30, cast=int),
+    300: config("CANDLES_5M_RETENTION_DAYS", default=180, cast=int),
+    3600: config("CANDLES_1H_RETENTION_DAYS", default=0, cast=int),
+    86400: config("CANDLES_1D_RETENTION_DAYS", default=0, cast=int)
+}
+
 TELEGRAM_TOKEN = str(config("TELEGRAM_TOKEN"))
 TELEGRAM_CHAT_ID = str(config("TELEGRAM_CHAT_ID"))
 
+PRICE_WRITER_BATCH_SIZE = config("PRICE_WRITER_BATCH_SIZE", default=500, cast=int)
+PRICE_WRITER_FLUSH_SECONDS = config("PRICE_WRITER_FLUSH_SECONDS", default=1.0, cast=float)
+
+# Point at a local sink (tools/webhook_sink.py) for load tests
+DISCORD_API_BASE_URL = config("DISCORD_API_BASE_URL", default="https://discord.com")
+NOTIFICATIONS = NotificationDispatcher(
+    max_queue_size=config("NOTIFICATION_QUEUE_SIZE", default=1000, cast=int),
+    workers=config("NOTIFICATION_WORKERS", default=4, cast=int))
+ALERTS = AlertAggregator(
+    NOTIFICATIONS,
+    window=config("ALERT_FLUSH_SECONDS", default=2.0, cast=float),
+    cooldown=config("ALERT_COOLDOWN_SECONDS", default=300.0, cast=float),
+    state=SHARED_STATE)
+
 Base = declarative_base()
 
 """
@@ -59,37 +133,43 @@ Base = declarative_base()
  }
 }
 
-extra can be empty
+extra can be empty, "symbol" in extra is used to merge alerts, "time_frame" and "price_change" are
+counted by backtest.py
 types: [price_change, price_level]
 """
 
 
 def sendNotification(notification_dict: {}):
     notification_text, notification_type, extra = notification_dict.values()
+    ALERTS_TOTAL.inc(notification_type)
+    symbol = extra.get("symbol", notification_text)
     if notification_type == "price_change":
         if extra["went_up"]:
             format_to_add = "fix\n"
         else:
             format_to_add = "\n"
         ratio_if_higher_price = float(extra["ratio_if_higher_price"])
+        # Only the most significant timeframe per symbol and direction gets through, a reversal is not a repeat
+        key = (symbol, notification_type, bool(extra["went_up"]))
 
         # DISCORD
-        url = ("https://discord.com/api/webhooks/1214234724902502482/"
+        url = (f"{DISCORD_API_BASE_URL}/api/webhooks/1214234724902502482/"
                "Mxz0D4ah2vplk_2_RmbnROkDeR5fcwArjE8Y6iERFoAD8YftfwgQtaoBl6M_CIgctRfI")
-        requests.post(url, data={"content": f"```{format_to_add}{notification_text}```"})
+        ALERTS.add(url, key, ratio_if_higher_price, format_to_add, notification_text)
         if 2.0 <= ratio_if_higher_price < 3:
-            url = ("https://discord.com/api/webhooks/1214260685245251667/"
+            url = (f"{DISCORD_API_BASE_URL}/api/webhooks/1214260685245251667/"
                    "e1DgPPFPdTF8kAPZwrw6Tpwslv0ATLLl8UZTIhBoFgquj5AeyoFXtzsPwZIIimSvKmiY")
-            requests.post(url, data={"content": f"```{format_to_add}{notification_text}```"})
+            ALERTS.add(url, key, ratio_if_higher_price, format_to_add, notification_text)
         elif ratio_if_higher_price >= 3:
-            url = ("https://discord.com/api/webhooks/1214262555338604584/"
+            url = (f"{DISCORD_API_BASE_URL}/api/webhooks/1214262555338604584/"
                    "dDW94T66wgX9FMZb9eGo-ZEdLptoaSukFTQWoOJc1edkaowcGHk1SukElO1uFNL0wXMf")
-            requests.post(url, data={"content": f"```{format_to_add}{notification_text}```"})
+            ALERTS.add(url, key, ratio_if_higher_price, format_to_add, notification_text)
 
     elif notification_type == "price_level":
-        url = ("https://discord.com/api/webhooks/1217248564540084314/"
+        url = (f"{DISCORD_API_BASE_URL}/api/webhooks/1217248564540084314/"
                "8qt6adXJzUtew5K_Et0pGoQ87JLiBE0pWLgEjce5dJGlv4KYagNROJUmSOLuPntbc-Dj")
-        requests.post(url, data={"content": f"```fix\n{notification_text}```"})
+        key = (symbol, notification_type, extra.get("price_level"), extra.get("event"))
+        ALERTS.add(url, key, 1.0, "fix\n", notification_text)
     else:
         print(f"Dont know type: {notification_type}")
         return
@@ -129,211 +209,394 @@ class BaseModel(Base):
 
 class TokenPrice(BaseModel):
     __tablename__ = "token_prices"
+    __table_args__ = (Index("ix_token_prices_token_id_ts", "token_id", "ts"),)
 
     token_id: Mapped[int] = mapped_column(Integer, ForeignKey("tokens.id"))
     # token: Mapped[Token] = relationship(back_populates="token_prices")
     price = Column(Float)
+    # Epoch seconds, rows from before the migration (migrate.py) only have the datetime string
+    ts = Column(Integer)
     datetime = Column(String)
 
+    def getTimestamp(self) -> int:
+        if self.ts is not None:
+            return self.ts
+        return toEpoch(parseDateTime(self.datetime))
+
     def getDateTime(self):
-        return datetime.strptime(str(self.datetime), "%Y-%m-%d %H:%M:%S")
+        return fromEpoch(self.getTimestamp())
 
 
-class Token(BaseModel):
-    __tablename__ = "tokens"
+class Candle(BaseModel):
+    __abstract__ = True
 
-    symbol = Column(String)
-    currency = Column(String, default="USD")
-    token_prices: Mapped[Set[TokenPrice]] = relationship()
+    token_id: Mapped[int] = mapped_column(Integer, ForeignKey("tokens.id"))
+    # Bucket start, epoch seconds
+    ts = Column(Integer)
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
 
-    def getCurrentPrice(self):
-        if not self.token_prices:
-            return 0.0
 
-        last = self.getNearestPriceEntryToTimeframe(time_frame={"minutes": 1})
-        # print(last.price)
-        return last.price if last is not None else 0.0
+class Candle1m(Candle):
+    __tablename__ = "candles_1m"
+    __table_args__ = (Index("ux_candles_1m_token_id_ts", "token_id", "ts", unique=True),)
 
-    def addPriceEntry(self, price: float, _datetime: datetime, session):
-        if self.getCurrentPrice() == price:
-            return
-        new_token_price = TokenPrice(price=price, datetime=_datetime)
-        self.token_prices.add(new_token_price)
-        session.add(new_token_price)
-        session.commit()
-        self.checkIfPriceChanged(time_frame={"minutes": 5},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_5M,
-                                 _current_price=price, _current_datetime=_datetime)
-        self.checkIfPriceChanged(time_frame={"minutes": 15},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_15M,
-                                 _current_price=price, _current_datetime=_datetime)
-        self.checkIfPriceChanged(time_frame={"minutes": 30},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_30M,
-                                 _current_price=price, _current_datetime=_datetime)
-        self.checkIfPriceChanged(time_frame={"hours": 1},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_1H,
-                                 _current_price=price, _current_datetime=_datetime)
-        self.checkIfPriceChanged(time_frame={"hours": 4},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_4H,
-                                 _current_price=price, _current_datetime=_datetime)
-        self.checkIfPriceChanged(time_frame={"hours": 8},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_8H,
-                                 _current_price=price, _current_datetime=_datetime)
-        self.checkIfPriceChanged(time_frame={"hours": 24},
-                                 min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_24H,
-                                 _current_price=price, _current_datetime=_datetime)
-        # self.checkIfPriceChanged(time_frame={"days": 7},
-        #                         min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_7D,
-        #                         _current_price=price, _current_datetime=_datetime)
-        # self.checkIfPriceChanged(time_frame={"days": 30},
-        #                         min_price_change_percent=MINIMUM_PRICE_CHANGE_TO_ALERT_30D,
-        #                         _current_price=price, _current_datetime=_datetime)
 
-    def getNearestPriceEntryToTimeframe(self, time_frame):
-        # Parse current datetime
-        current_datetime = datetime.now()
+class Candle5m(Candle):
+    __tablename__ = "candles_5m"
+    __table_args__ = (Index("ux_candles_5m_token_id_ts", "token_id", "ts", unique=True),)
+
+
+class Candle1h(Candle):
+    __tablename__ = "candles_1h"
+    __table_args__ = (Index("ux_candles_1h_token_id_ts", "token_id", "ts", unique=True),)
+
+
+class Candle1d(Candle):
+    __tablename__ = "candles_1d"
+    __table_args__ = (Index("ux_candles_1d_token_id_ts", "token_id", "ts", unique=True),)
+
+
+CANDLE_TABLES = {
+    60: Candle1m.__table__,
+    300: Candle5m.__table__,
+    3600: Candle1h.__table__,
+    86400: Candle1d.__table__
+}
 
-        # Initialize variables to store the closest entry and its difference
-        closest_entry = None
-        closest_difference = timedelta.max  # Initialize with a large value
 
-        # Define the timedelta object
-        time_delta = timedelta(**time_frame)
+class RollupState(Base):
+    __tablename__ = "rollup_state"
 
-        # Get the reference time by subtracting the time delta from the current datetime
-        reference_time = current_datetime - time_delta
+    # Candle interval in seconds, candles are complete up to watermark (epoch seconds)
+    interval = Column(Integer, primary_key=True)
+    watermark = Column(Integer)
 
-        # Iterate through each entry in price history
-        for entry in self.token_prices:
-            # Calculate the difference between the timestamp and the current time
-            time_difference = abs(entry.getDateTime() - reference_time)
 
-            # Check if the current entry is closer than the current closest entry
-            if time_difference < closest_difference:
-                closest_entry = entry
-                closest_difference = time_difference
+class Token(BaseModel):
+    __tablename__ = "tokens"
+
+    symbol = Column(String, unique=True)
+    currency = Column(String, default="USD")
+    # Never loaded from the database, price history is read in bulk by Repository.loadTokenHistory
+    token_prices: Mapped[Set[TokenPrice]] = relationship(lazy="raise")
+
+    # In-memory (ts, price) series
+    price_history: PriceHistory = None
+    # Window length in seconds -> SlidingWindowExtremes, created on first use
+    window_trackers: dict = None
+    # candle_loader(since_ts, until_ts) -> Repository.loadCandleStats for this token
+    candle_loader = None
+    # Window length in seconds -> (hour it was loaded in, candle stats) for windows longer than the history
+    candle_stats: dict = None
+
+    def getPriceHistory(self) -> PriceHistory:
+        if self.price_history is None:
+            self.price_history = PriceHistory()
+        return self.price_history
+
+    def addToPriceHistory(self, ts: int, price: float):
+        history = self.getPriceHistory()
+        last = history.getLast()
+        history.add(ts, price)
+        if len(history) and history.timestamps[0] < ts - HISTORY_RETENTION_SECONDS - 3600:
+            # Trimmed an hour at a time, older entries can still be loaded back from the database
+            history.trimBefore(ts - HISTORY_RETENTION_SECONDS)
+        if not self.window_trackers:
+            return
+        if last is not None and ts < last[0]:
+            # Out of order tick, trackers get rebuilt from history on next use
+            self.window_trackers = None
+            return
+        for tracker in self.window_trackers.values():
+            tracker.push(ts, price)
+
+    def getWindowTracker(self, window: int, now_ts: int) -> SlidingWindowExtremes:
+        if self.window_trackers is None:
+            self.window_trackers = {}
+        tracker = self.window_trackers.get(window)
+        if tracker is None:
+            tracker = SlidingWindowExtremes.fromHistory(self.getPriceHistory(), window, now_ts)
+            self.window_trackers[window] = tracker
+        else:
+            tracker.evict(now_ts)
+        return tracker
 
-        return closest_entry
+    def getCurrentPrice(self):
+        last = self.getNearestPriceEntryToTimeframe(time_frame={"minutes": 1})
+        # print(last.price)
+        return last[1] if last is not None else 0.0
+
+    def addPriceEntry(self, price: float, _datetime: datetime, price_writer: PriceWriter):
+        if self.getCurrentPrice() == price:
+            DUPLICATE_TICKS.inc()
+            return
+        ts = toEpoch(_datetime)
+        # Written to the database in the background, the in-memory history is what alerts use
+        time_start = time.perf_counter()
+        price_writer.add({"token_id": self.id, "price": price, "ts": ts})
+        STAGE_SECONDS.observe(time.perf_counter() - time_start, "db_write")
+        self.evaluatePriceEntry(price, _datetime, ts)
+
+    def evaluatePriceEntry(self, price: float, _datetime: datetime, ts: int):
+        # Adds the tick to the history and sends the alerts it triggers, without writing it to the database
+        if SHARED_STATE is not None:
+            SHARED_STATE.addPrice(str(self.symbol), ts, price)
+        else:
+            self.addToPriceHistory(ts, price)
+        if SWEEP is None:
+            time_start = time.perf_counter()
+            now_ts = toEpoch(CLOCK())
+            for evaluation in self.evaluateTimeframes(ALERT_TIMEFRAMES, price, now_ts):
+                self.checkIfPriceChanged(evaluation, _current_price=price, _current_datetime=_datetime)
+            STAGE_SECONDS.observe(time.perf_counter() - time_start, "timeframes")
+        else:
+            SWEEP.add(str(self.symbol), ts, price)
+        time_start = time.perf_counter()
+        self.checkPriceLevels(price, _datetime, ts)
+        STAGE_SECONDS.observe(time.perf_counter() - time_start, "price_levels")
+
+    @staticmethod
+    def makeEvaluation(time_frame, min_price_change_percent, historic_ts: int, historic_price, window_max,
+                       window_min, _current_price):
+        return {
+            "time_frame": time_frame,
+            "min_price_change_percent": min_price_change_percent,
+            "historic_ts": historic_ts,
+            "historic_price": historic_price,
+            "window_max": window_max,
+            "window_min": window_min,
+            "price_change": (_current_price / historic_price * 100) - 100,
+            "wasATH": window_max is None or window_max <= _current_price,
+            "wasATL": window_min is None or window_min >= _current_price
+        }
 
-    def checkIfPriceChanged(self, time_frame, min_price_change_percent: float, _current_price, _current_datetime):
-        # print(f"{self.getCurrentPrice()} | {len(self.price_history)}")
-        historic_price_obj = self.getNearestPriceEntryToTimeframe(time_frame)
-        historic_price = historic_price_obj.price
-        historic_price_timestamp = (datetime.strptime(historic_price_obj.datetime, '%Y-%m-%d %H:%M:%S')
-                                    + timedelta(hours=1))
+    def evaluateTimeframes(self, timeframes, _current_price, now_ts: int):
+        # One pass over all timeframes (shortest first): reference price, window max/min and change in %.
+        # Reference times only go further back, so each bisect only has to search below the previous one.
+        if SHARED_STATE is not None:
+            return self.evaluateSharedTimeframes(timeframes, _current_price, now_ts)
+        history = self.getPriceHistory()
+        if len(history) == 0:
+            return []
+        evaluations = []
+        upper_bound = len(history)
+        for time_frame, min_price_change_percent in timeframes:
+            time_start = time.perf_counter()
+            window = timeFrameToSeconds(time_frame)
+            if window > HISTORY_RETENTION_SECONDS:
+                # Older part of the window comes from the candles, the rest from the in-memory history
+                stats = self.getCandleStats(window, now_ts)
+                if stats is None:
+                    continue
+                historic_ts, historic_price, window_max, window_min = stats
+                tracker = self.getWindowTracker(HISTORY_RETENTION_SECONDS, now_ts)
+                if tracker.getMax() is not None:
+                    window_max = tracker.getMax() if window_max is None else max(window_max, tracker.getMax())
+                    window_min = tracker.getMin() if window_min is None else min(window_min, tracker.getMin())
+            else:
+                index = history.getNearestIndex(now_ts - window, upper_bound)
+                upper_bound = index + 1
+                historic_ts = history.timestamps[index]
+                historic_price = history.prices[index]
+                tracker = self.getWindowTracker(window, now_ts)
+                window_max = tracker.getMax()
+                window_min = tracker.getMin()
+            evaluations.append(self.makeEvaluation(time_frame, min_price_change_percent, historic_ts,
+                                                   historic_price, window_max, window_min, _current_price))
+            TIMEFRAME_SECONDS.observe(time.perf_counter() - time_start,
+                                      TIMEFRAME_LABELS.get(window) or getTimeFrameLabel(time_frame))
+        return evaluations
+
+    def evaluateSharedTimeframes(self, timeframes, _current_price, now_ts: int):
+        # Same as evaluateTimeframes, with all windows read from SHARED_STATE in one call
+        windows = [timeFrameToSeconds(time_frame) for time_frame, _ in timeframes]
+        time_start = time.perf_counter()
+        states = SHARED_STATE.getWindows(str(self.symbol), [min(window, HISTORY_RETENTION_SECONDS)
+                                                            for window in windows], now_ts)
+        STAGE_SECONDS.observe(time.perf_counter() - time_start, "shared_state_read")
+        evaluations = []
+        for (time_frame, min_price_change_percent), window, (reference, window_max, window_min) in zip(
+                timeframes, windows, states):
+            if window > HISTORY_RETENTION_SECONDS:
+                stats = self.getCandleStats(window, now_ts)
+                if stats is None:
+                    continue
+                historic_ts, historic_price, candles_max, candles_min = stats
+                if window_max is None:
+                    window_max, window_min = candles_max, candles_min
+                elif candles_max is not None:
+                    window_max, window_min = max(window_max, candles_max), min(window_min, candles_min)
+            elif reference is None:
+                continue
+            else:
+                historic_ts, historic_price = reference
+            evaluations.append(self.makeEvaluation(time_frame, min_price_change_percent, historic_ts,
+                                                   historic_price, window_max, window_min, _current_price))
+        return evaluations
+
+    def getCandleStats(self, window: int, now_ts: int):
+        # Candles only change once an hour, so the query result is reused within the hour
+        if self.candle_loader is None:
+            return None
+        if self.candle_stats is None:
+            self.candle_stats = {}
+        hour = now_ts // 3600
+        cached = self.candle_stats.get(window)
+        if cached is None or cached[0] != hour:
+            cached = (hour, self.candle_loader(now_ts - window, now_ts - HISTORY_RETENTION_SECONDS))
+            self.candle_stats[window] = cached
+        return cached[1]
 
-        ATH_ATL = self.checkIfPriceWasATHorATL(time_frame, _current_price)
-        wasATH = ATH_ATL["wasATH"]
-        wasATL = ATH_ATL["wasATL"]
+    def getNearestPriceEntryToTimeframe(self, time_frame):
+        # Returns (ts, price) of the entry closest to now - time_frame, or None
+        reference_time = CLOCK() - timedelta(**time_frame)
+        if SHARED_STATE is not None:
+            return SHARED_STATE.getNearest(str(self.symbol), toEpoch(reference_time))
+        return self.getPriceHistory().getNearest(toEpoch(reference_time))
+
+    def checkIfPriceChanged(self, evaluation: dict, _current_price, _current_datetime):
+        time_frame = evaluation["time_frame"]
+        min_price_change_percent = evaluation["min_price_change_percent"]
+        historic_price = evaluation["historic_price"]
+        historic_price_timestamp = fromEpoch(evaluation["historic_ts"]) + timedelta(hours=1)
+
+        wasATH = evaluation["wasATH"]
+        wasATL = evaluation["wasATL"]
         if _current_price > historic_price and wasATH:
-            price_change = (_current_price / historic_price * 100) - 100
+            price_change = evaluation["price_change"]
             price_change = float("{:.3f}".format(price_change))
-            notification = (f"{self.symbol}\n"
-                            f"{historic_price} => {_current_price}$\n"
-                            f"ATH in {time_frame}\n"
-                            f"📗{price_change}%\n"
-                            f"{historic_price_timestamp} | {_current_datetime}")
             if price_change >= min_price_change_percent:
+                # Only built for alerts that fire, most evaluations don't
+                notification = (f"{self.symbol}\n"
+                                f"{historic_price} => {_current_price}$\n"
+                                f"ATH in {time_frame}\n"
+                                f"📗{price_change}%\n"
+                                f"{historic_price_timestamp} | {_current_datetime}")
                 notification_to_send = {
                     "notification_text": notification,
                     "notification_type": "price_change",
                     "extra": {
                         "ratio_if_higher_price": float(price_change / min_price_change_percent),
-                        "went_up": True
+                        "went_up": True,
+                        "symbol": str(self.symbol),
+                        "time_frame": getTimeFrameLabel(time_frame),
+                        "price_change": price_change
                     }
                 }
                 sendNotification(notification_to_send)
 
         elif _current_price < historic_price and wasATL:
-            price_change = 100 - (_current_price / historic_price * 100)
+            price_change = -evaluation["price_change"]
             price_change = float("{:.3f}".format(price_change))
-            notification = (f"{self.symbol}\n"
-                            f"{historic_price} => {_current_price}$\n"
-                            f"ATL in {time_frame}\n"
-                            f"📉{price_change}%\n"
-                            f"{historic_price_timestamp} | {_current_datetime}\n")
             if price_change >= min_price_change_percent:
+                notification = (f"{self.symbol}\n"
+                                f"{historic_price} => {_current_price}$\n"
+                                f"ATL in {time_frame}\n"
+                                f"📉{price_change}%\n"
+                                f"{historic_price_timestamp} | {_current_datetime}\n")
                 notification_to_send = {
                     "notification_text": notification,
                     "notification_type": "price_change",
                     "extra": {
                         "ratio_if_higher_price": float(price_change / min_price_change_percent),
-                        "went_up": False
+                        "went_up": False,
+                        "symbol": str(self.symbol),
+                        "time_frame": getTimeFrameLabel(time_frame),
+                        "price_change": price_change
                     }
                 }
                 sendNotification(notification_to_send)
         else:
-            price_change = 100 - (_current_price / historic_price * 100)
+            price_change = -evaluation["price_change"]
             price_change = float("{:.3f}".format(price_change))
-            notification = (f"{self.symbol}\n"
-                            f"📉{price_change}%\n"
-                            f"{historic_price} => {_current_price}$\n"
-                            f"{historic_price_timestamp} | {_current_datetime}\n"
-                            f"======================")
             if price_change >= min_price_change_percent:
+                notification = (f"{self.symbol}\n"
+                                f"📉{price_change}%\n"
+                                f"{historic_price} => {_current_price}$\n"
+                                f"{historic_price_timestamp} | {_current_datetime}\n"
+                                f"======================")
                 print(notification)
 
-        # PRICE LEVEL CHECKS
-        result_is_true, price_level = checkIfPriceIsAroundPriceLevel(str(self.symbol), _current_price, 0.015).values()
-        if result_is_true:
+    def checkPriceLevels(self, _current_price, _current_datetime, ts: int):
+        for price_level, event in PRICE_LEVEL_ALERTS.update(str(self.symbol), _current_price, ts):
+            if event == "entered":
+                description = f"is near price level {price_level}$"
+            elif event == "crossed_up":
+                description = f"crossed price level {price_level}$ upwards"
+            else:
+                description = f"crossed price level {price_level}$ downwards"
             notification = (f"{self.symbol}\n"
-                            f"is near price level {price_level}$\n"
+                            f"{description}\n"
                             f"Current price: {_current_price}$\n"
                             f"{_current_datetime}")
             notification_to_send = {
                 "notification_text": notification,
                 "notification_type": "price_level",
-                "extra": {}
+                "extra": {
+                    "symbol": str(self.symbol),
+                    "price_level": price_level,
+                    "event": event
+                }
             }
             sendNotification(notification_to_send)
 
-    def checkIfPriceWasATHorATL(self, time_delta, _current_price):
-        # Define the time threshold (1 hour)
-        time_threshold = timedelta(**time_delta)
-
-        result = {
-            "wasATH": True,
-            "wasATL": True
-        }
-
-        # Iterate over price history
-        for entry in self.token_prices:
-            # Check if the timestamp is within the time threshold
-            if datetime.now() - entry.getDateTime() < time_threshold:
-                # Check if the price has changed
-                if entry.price > _current_price:
-                    result["wasATH"] = False
-                elif entry.price < _current_price:
-                    result["wasATL"] = False
-        return result
-
 
 class Repository:
     def __init__(self):
         self.session = None
+        self.engine = None
+        self.price_writer: PriceWriter = None
+        self.rollups: RollupJob = None
         self.tokens: Set[Token] = set()
+        self.tokens_by_symbol: Dict[str, Token] = {}
+        self.tokens_lock = threading.Lock()
 
     def addNewToken(self, symbol: str):
-        newToken = Token(symbol=symbol)
-        self.session.add(newToken)
-        self.tokens.add(newToken)
-        self.session.commit()
-        return newToken
+        token, _ = self.getOrCreateToken(symbol)
+        return token
 
     def findToken(self, symbol: str):
-        _id: int = 0
-        for entry in self.tokens:
-            if entry.symbol == symbol:
-                return entry, _id
-            _id += 1
-        return None, -1
-
-    def initializeDB(self):
+        token = self.tokens_by_symbol.get(symbol)
+        if token is None:
+            return None, -1
+        return token, token.id
+
+    def getOrCreateToken(self, symbol: str):
+        # Returns (token, created). tokens.symbol is unique, so if another worker inserted the symbol
+        # first, the insert fails and its row is used instead.
+        token = self.tokens_by_symbol.get(symbol)
+        if token is not None:
+            return token, False
+        with self.tokens_lock:
+            token = self.tokens_by_symbol.get(symbol)
+            if token is not None:
+                return token, False
+            created = True
+            token = Token(symbol=symbol)
+            self.session.add(token)
+            try:
+                self.session.commit()
+                token.price_history = PriceHistory()
+                token.candle_loader = partial(self.loadCandleStats, token.id)
+            except IntegrityError:
+                self.session.rollback()
+                token = self.session.query(Token).filter(Token.symbol == symbol).one()
+                self.loadTokenHistory(token, toEpoch(datetime.now()) - HISTORY_RETENTION_SECONDS)
+                created = False
+            self.tokens.add(token)
+            self.tokens_by_symbol[symbol] = token
+            return token, created
+
+    def initializeDB(self, background_jobs: bool = True):
+        # background_jobs=False (evaluation workers) only reads, the ingest process writes and rolls up
         if not os.path.exists("database.db"):
             # Migrate from json
-            engine = create_engine("sqlite:///database.db")
+            engine = createEngine("database.db")
             Base.metadata.create_all(engine)
-            self.session = sessionmaker(bind=engine)()
+            self.session = sessionmaker(bind=engine, expire_on_commit=False)()
 
             print("Starting to migrate from JSON to SQLite")
             time_start = datetime.now()
@@ -341,12 +604,92 @@ class Repository:
             time_end = datetime.now()
             print(f"Migration completed... Took {time_end - time_start}")
         else:
-            engine = create_engine("sqlite:///database.db")
+            engine = createEngine("database.db")
             Base.metadata.create_all(engine)
-            self.session = sessionmaker(bind=engine)()
-
+            ensureSchema(engine)
+            self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+
+        if background_jobs:
+            self.price_writer = PriceWriter(engine, TokenPrice.__table__,
+                                            max_buffered=PRICE_WRITER_BATCH_SIZE,
+                                            flush_interval=PRICE_WRITER_FLUSH_SECONDS)
+            self.price_writer.start()
+            self.rollups = RollupJob(engine, CANDLE_TABLES, run_every=ROLLUP_INTERVAL_SECONDS,
+                                     raw_retention_days=RAW_PRICES_RETENTION_DAYS,
+                                     candle_retention_days=CANDLE_RETENTION_DAYS)
+            if ROLLUPS_ENABLED:
+                self.rollups.start()
+        self.engine = engine
         self.tokens = set(self.session.query(Token).all())
+        self.tokens_by_symbol = {str(token.symbol): token for token in self.tokens}
         print(f"Loaded {len(self.tokens)} tokens")
+        time_start = datetime.now()
+        loaded_prices = self.loadRecentHistory(toEpoch(datetime.now()) - HISTORY_RETENTION_SECONDS)
+        print(f"Loaded {loaded_prices} prices from the last {HISTORY_RETENTION_SECONDS}s... "
+              f"Took {datetime.now() - time_start}")
+        if SHARED_STATE is not None:
+            self.seedSharedState()
+        if SWEEP is not None:
+            for token in self.tokens:
+                history = token.getPriceHistory()
+                for ts, price in zip(history.timestamps, history.prices):
+                    SWEEP.add(str(token.symbol), ts, price, evaluate=False)
+
+    def runSweep(self, now_ts: int):
+        for symbol, timeframe_index, historic_ts, historic_price, window_max, window_min, price, ts in \
+                SWEEP.sweep(now_ts):
+            token = self.tokens_by_symbol.get(symbol)
+            if token is None:
+                continue
+            time_frame, min_price_change_percent = SWEEP.timeframes[timeframe_index]
+            evaluation = Token.makeEvaluation(time_frame, min_price_change_percent, historic_ts, historic_price,
+                                              window_max, window_min, price)
+            token.checkIfPriceChanged(evaluation, _current_price=price, _current_datetime=fromEpoch(ts))
+
+    def seedSharedState(self):
+        # Entries are idempotent, so every worker starting up can seed the shared state from the database.
+        # The local copies are dropped afterwards, the evaluation reads the shared state only.
+        for token in self.tokens:
+            history = token.getPriceHistory()
+            SHARED_STATE.addPrices(str(token.symbol), zip(history.timestamps, history.prices))
+            token.price_history = PriceHistory()
+
+    def loadPrices(self, token_id: int, since_ts: int, until_ts: int = None):
+        # [since_ts, until_ts) for one token, straight from the (token_id, ts) index without ORM objects
+        query = "SELECT ts, price FROM token_prices WHERE token_id = ? AND ts >= ?"
+        parameters = [token_id, since_ts]
+        if until_ts is not None:
+            query += " AND ts < ?"
+            parameters.append(until_ts)
+        with self.engine.connect() as connection:
+            return connection.exec_driver_sql(query + " ORDER BY ts", tuple(parameters)).fetchall()
+
+    def loadCandleStats(self, token_id: int, since_ts: int, until_ts: int):
+        # From the 1h candles: (ts, open) of the first candle at or after since_ts, the price nearest to
+        # since_ts, and the highest high and lowest low in [since_ts, until_ts). None if there are no candles yet.
+        with self.engine.connect() as connection:
+            reference = connection.exec_driver_sql(
+                "SELECT ts, open FROM candles_1h WHERE token_id = ? AND ts >= ? AND ts < ? ORDER BY ts LIMIT 1",
+                (token_id, since_ts, until_ts)).fetchone()
+            if reference is None:
+                return None
+            window_max, window_min = connection.exec_driver_sql(
+                "SELECT MAX(high), MIN(low) FROM candles_1h WHERE token_id = ? AND ts >= ? AND ts < ?",
+                (token_id, since_ts, until_ts)).fetchone()
+        return reference[0], reference[1], window_max, window_min
+
+    def loadTokenHistory(self, token: Token, since_ts: int):
+        history = PriceHistory(loaded_from=since_ts)
+        for ts, price in self.loadPrices(token.id, since_ts):
+            history.timestamps.append(ts)
+            history.prices.append(price)
+        token.price_history = history
+        token.window_trackers = None
+        token.candle_loader = partial(self.loadCandleStats, token.id)
+        return len(history)
+
+    def loadRecentHistory(self, since_ts: int):
+        return sum(self.loadTokenHistory(token, since_ts) for token in self.tokens)
 
     def migrateJSONtoDB(self):
         if not os.path.exists("prices.json"):
@@ -362,6 +705,7 @@ class Repository:
                     timestamp = price_history_entry["datetime"]
                 except:
                     timestamp = price_history_entry["timestamp"]
-                __token.token_prices.add(TokenPrice(price=price_history_entry["price"], datetime=timestamp))
+                __token.token_prices.add(TokenPrice(price=price_history_entry["price"],
+                                                    ts=toEpoch(parseDateTime(timestamp))))
             self.session.add(__token)
             self.session.commit()
@@ -0,0 +1,274 @@
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime
+import aiohttp
+import requests
+from metrics import STAGE_SECONDS
+from price_history import toEpoch
+
+
+class TokenBucket:
+    # rate tokens per second, up to capacity. Discord's rate limit headers can block the bucket until a reset.
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def blockFor(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def applyRateLimitHeaders(self, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None and int(remaining) == 0:
+            self.blockFor(float(reset_after))
+
+
+class NotificationDispatcher:
+    # Webhook posts go to a bounded queue drained by async workers sharing one keep-alive connection pool.
+    # Until start() is called (scripts, tools) posts are sent synchronously.
+    def __init__(self, max_queue_size: int = 1000, workers: int = 4, rate: float = 2.5, burst: float = 5,
+                 max_retries: int = 5, timeout: float = 10.0):
+        self.max_queue_size = max_queue_size
+        self.workers_count = workers
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.queue = None
+        self.loop = None
+        self.loop_thread_id = None
+        self.session = None
+        self.workers = []
+        self.buckets = {}
+        self.sync_session = None
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "failed": 0, "retried": 0, "rate_limited": 0}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.workers_count * 2, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, drain_timeout: float = 10.0):
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Notification queue not drained, {self.queue.qsize()} messages left")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        await self.session.close()
+        self.queue = None
+        self.workers = []
+
+    def post(self, url: str, content: str):
+        if self.queue is None:
+            self.postSync(url, content)
+        elif threading.get_ident() == self.loop_thread_id:
+            self.enqueue(url, content)
+        else:
+            self.loop.call_soon_threadsafe(self.enqueue, url, content)
+
+    def enqueue(self, url: str, content: str):
+        try:
+            self.queue.put_nowait((url, content))
+            self.stats["queued"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    def postSync(self, url: str, content: str):
+        if self.sync_session is None:
+            self.sync_session = requests.Session()
+        try:
+            with STAGE_SECONDS.time("notification_send"):
+                self.sync_session.post(url, data={"content": content}, timeout=self.timeout)
+            self.stats["sent"] += 1
+        except requests.RequestException as e:
+            self.stats["failed"] += 1
+            print(f"Could not send notification to {url}: {e}")
+
+    def getBucket(self, url: str) -> TokenBucket:
+        bucket = self.buckets.get(url)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[url] = bucket
+        return bucket
+
+    async def worker(self):
+        while True:
+            url, content = await self.queue.get()
+            try:
+                await self.deliver(url, content)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Could not send notification to {url}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def deliver(self, url: str, content: str):
+        bucket = self.getBucket(url)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.stats["retried"] += 1
+            await bucket.acquire()
+            time_start = time.perf_counter()
+            try:
+                async with self.session.post(url, data={"content": content}) as response:
+                    STAGE_SECONDS.observe(time.perf_counter() - time_start, "notification_send")
+                    bucket.applyRateLimitHeaders(response.headers)
+                    if response.status == 429:
+                        self.stats["rate_limited"] += 1
+                        bucket.blockFor(await self.getRetryAfter(response))
+                        continue
+                    if response.status < 500:
+                        if response.status >= 400:
+                            # Bad request or unknown webhook, retrying won't help
+                            self.stats["failed"] += 1
+                        else:
+                            self.stats["sent"] += 1
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            # Server error or connection problem, back off with jitter
+            await asyncio.sleep(min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        self.stats["failed"] += 1
+
+    @staticmethod
+    async def getRetryAfter(response) -> float:
+        try:
+            body = await response.json(content_type=None)
+            return float(body["retry_after"])
+        except (ValueError, KeyError, TypeError, aiohttp.ClientError):
+            return float(response.headers.get("Retry-After", 1.0))
+
+
+class AlertAggregator:
+    # Collects alerts per webhook for `window` seconds and sends them as few messages as fit in Discord's
+    # content limit. Per key (e.g. symbol + alert type) only the most significant alert of a window is kept,
+    # and a key is not sent again within cooldown seconds unless it got more significant. With a state backend
+    # (state.py) the cooldowns are shared by all coordinator workers, otherwise they are kept here.
+    MAX_MESSAGE_LENGTH = 2000
+
+    def __init__(self, dispatcher: NotificationDispatcher, window: float = 2.0, cooldown: float = 300.0, state=None):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.cooldown = cooldown
+        self.state = state
+        # url -> {key: (significance, block_format, text)}
+        self.pending = {}
+        # (url, key) -> (monotonic time, significance) of the last sent alert
+        self.last_sent = {}
+        self.flush_task = None
+        self.loop = None
+        self.loop_thread_id = None
+        self.stats = {"alerts": 0, "merged": 0, "suppressed": 0, "messages": 0}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.flush_task = asyncio.create_task(self.flushPeriodically())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+        self.loop = None
+        self.flush()
+
+    async def flushPeriodically(self):
+        while True:
+            await asyncio.sleep(self.window)
+            self.flush()
+
+    def add(self, url: str, key, significance: float, block_format: str, text: str):
+        if self.loop is not None and threading.get_ident() != self.loop_thread_id:
+            # From another thread (the jobs of jobs.py), pending alerts are only touched on the loop
+            self.loop.call_soon_threadsafe(self.add, url, key, significance, block_format, text)
+            return
+        self.stats["alerts"] += 1
+        alerts = self.pending.setdefault(url, {})
+        current = alerts.get(key)
+        if current is not None:
+            self.stats["merged"] += 1
+            if significance <= current[0]:
+                return
+        alerts[key] = (significance, block_format, text)
+        if self.flush_task is None:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        now = time.monotonic()
+        for url, alerts in pending.items():
+            blocks = []
+            for key, (significance, block_format, text) in alerts.items():
+                if not self.claim(url, key, significance, now):
+                    self.stats["suppressed"] += 1
+                    continue
+                blocks.append((block_format, text))
+            for content in self.packMessages(blocks):
+                self.stats["messages"] += 1
+                self.dispatcher.post(url, content)
+        if len(self.last_sent) > 10000:
+            self.last_sent = {key: value for key, value in self.last_sent.items()
+                              if now - value[0] < self.cooldown}
+
+    def claim(self, url: str, key, significance: float, now: float) -> bool:
+        if self.state is not None:
+            return self.state.claimAlert(f"alert:{url}:{key}", significance, toEpoch(datetime.now()), self.cooldown)
+        last_sent = self.last_sent.get((url, key))
+        if last_sent is not None and now - last_sent[0] < self.cooldown and significance <= last_sent[1]:
+            return False
+        self.last_sent[(url, key)] = (now, significance)
+        return True
+
+    def packMessages(self, blocks):
+        # Alerts with the same block format share one ``` block, blocks are split at the length limit
+        messages = []
+        current_format = None
+        current_texts = []
+        current_length = 0
+        for block_format, text in sorted(blocks, key=lambda block: block[0]):
+            text = text.strip("\n")
+            overhead = len("```") + len(block_format) + len("```")
+            text = text[:self.MAX_MESSAGE_LENGTH - overhead]
+            if current_texts and (block_format != current_format or
+                                  current_length + len("\n\n") + len(text) > self.MAX_MESSAGE_LENGTH):
+                messages.append(f"```{current_format}" + "\n\n".join(current_texts) + "```")
+                current_texts = []
+            if not current_texts:
+                current_format = block_format
+                current_length = overhead + len(text)
+            else:
+                current_length += len("\n\n") + len(text)
+            current_texts.append(text)
+        if current_texts:
+            messages.append(f"```{current_format}" + "\n\n".join(current_texts) + "```")
+        return messages
@@ -0,0 +1,181 @@
+import atexit
+import mmap
+import os
+import struct
+import threading
+import time
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import IntegrityError
+from metrics import DB_FLUSH_SECONDS
+
+PENDING_STATE_FORMAT = "<qq"  # rows buffered but not flushed yet, clean shutdown flag
+
+
+def createEngine(path: str = "database.db"):
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def setSQLitePragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets the writer thread commit while the API reads, NORMAL only fsyncs at checkpoints
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    return engine
+
+
+def ensureSchema(engine):
+    # Cheap upgrades of an existing database.db. Converting old rows, merging duplicate tokens and building
+    # the (token_id, ts) index is left to migrate.py, which does it in small chunks.
+    with engine.begin() as connection:
+        columns = [row[1] for row in connection.execute(text("PRAGMA table_info(token_prices)"))]
+        if "ts" not in columns:
+            connection.execute(text("ALTER TABLE token_prices ADD COLUMN ts INTEGER"))
+        indexes = [row[1] for row in connection.execute(text("PRAGMA index_list(token_prices)"))]
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_tokens_symbol ON tokens (symbol)"))
+    except IntegrityError:
+        print("tokens has duplicate symbols, run: python migrate.py")
+    if "ix_token_prices_token_id_ts" not in indexes:
+        print("token_prices has no (token_id, ts) index yet, run: python migrate.py")
+        return False
+    return True
+
+
+def isProcessAlive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class PriceWriter:
+    # Write-behind buffer for token_prices rows, bulk inserted by a background thread when max_buffered
+    # rows are waiting or every flush_interval seconds. The number of buffered rows is mirrored into a small
+    # mmap'ed state file (no syscall per row), so after a crash the next start can tell how many were lost.
+    # Every process has its own state file ({state_path}.{pid}), several coordinator workers can share a
+    # database.
+    def __init__(self, engine, table, max_buffered: int = 500, flush_interval: float = 1.0,
+                 state_path: str = "database.db.pending"):
+        self.engine = engine
+        self.table = table
+        self.max_buffered = max_buffered
+        self.flush_interval = flush_interval
+        self.state_prefix = state_path
+        self.state_path = f"{state_path}.{os.getpid()}"
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.state = None
+        self.stats = {"buffered": 0, "written": 0, "flushes": 0, "failed_flushes": 0}
+
+    def reportLostRows(self):
+        # State files of processes that are gone (and the one without a pid of older versions) are read and
+        # removed, the ones of running workers are left alone
+        directory = os.path.dirname(self.state_prefix) or "."
+        name = os.path.basename(self.state_prefix)
+        lost = 0
+        for file_name in os.listdir(directory):
+            if file_name != name and not file_name.startswith(f"{name}."):
+                continue
+            pid = file_name[len(name) + 1:]
+            if pid.isdigit() and int(pid) != os.getpid() and isProcessAlive(int(pid)):
+                continue
+            path = os.path.join(directory, file_name)
+            lost += self.readLostRows(path)
+            os.remove(path)
+        return lost
+
+    @staticmethod
+    def readLostRows(path: str):
+        with open(path, "rb") as file:
+            data = file.read(struct.calcsize(PENDING_STATE_FORMAT))
+        if len(data) < struct.calcsize(PENDING_STATE_FORMAT):
+            return 0
+        pending, clean = struct.unpack(PENDING_STATE_FORMAT, data)
+        if not clean and pending > 0:
+            print(f"Previous run did not shut down cleanly, {pending} buffered price rows were lost ({path})")
+            return pending
+        return 0
+
+    def openState(self):
+        with open(self.state_path, "wb") as file:
+            file.write(struct.pack(PENDING_STATE_FORMAT, 0, 0))
+        file = open(self.state_path, "r+b")
+        self.state = mmap.mmap(file.fileno(), struct.calcsize(PENDING_STATE_FORMAT))
+        file.close()
+
+    def writeState(self, pending: int, clean: bool = False):
+        if self.state is not None:
+            struct.pack_into(PENDING_STATE_FORMAT, self.state, 0, pending, int(clean))
+
+    def start(self):
+        self.reportLostRows()
+        self.openState()
+        self.thread = threading.Thread(target=self.run, name="price-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wake_up.set()
+        self.thread.join()
+        self.thread = None
+        self.flush()
+        with self.lock:
+            pending = len(self.buffer)
+        self.writeState(pending, clean=pending == 0)
+        self.state.flush()
+
+    def add(self, row: dict):
+        with self.lock:
+            self.buffer.append(row)
+            pending = len(self.buffer)
+            self.writeState(pending)
+        self.stats["buffered"] += 1
+        if self.thread is None:
+            self.flush()
+        elif pending >= self.max_buffered:
+            self.wake_up.set()
+
+    def run(self):
+        while not self.stopping:
+            self.wake_up.wait(self.flush_interval)
+            self.wake_up.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+            if not rows:
+                return
+            time_start = time.perf_counter()
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(self.table.insert(), rows)
+            except Exception as e:
+                # Keep the rows for the next attempt
+                self.stats["failed_flushes"] += 1
+                print(f"Could not write {len(rows)} price rows: {e}")
+                with self.lock:
+                    self.buffer = rows + self.buffer
+                return
+            DB_FLUSH_SECONDS.observe(time.perf_counter() - time_start)
+            self.stats["written"] += len(rows)
+            self.stats["flushes"] += 1
+            with self.lock:
+                self.writeState(len(self.buffer))
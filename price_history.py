@@ -0,0 +1,135 @@
+import calendar
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime, timedelta
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH = datetime(1970, 1, 1)
+
+
+def toEpoch(_datetime: datetime) -> int:
+    # Naive datetimes are encoded as-is (as if they were UTC), so differences between
+    # two encoded values are the same as between the datetimes themselves
+    return calendar.timegm(_datetime.timetuple())
+
+
+def fromEpoch(ts: int) -> datetime:
+    return EPOCH + timedelta(seconds=ts)
+
+
+def parseDateTime(value) -> datetime:
+    # Accepts datetimes, epoch seconds and "%Y-%m-%d %H:%M:%S" / ISO strings
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return fromEpoch(int(value))
+    value = str(value)
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, DATETIME_FORMAT)
+
+
+def timeFrameToSeconds(time_frame: dict) -> int:
+    return int(timedelta(**time_frame).total_seconds())
+
+
+class PriceHistory:
+    # Parallel arrays of epoch seconds and prices, always sorted by time.
+    # Only entries from loaded_from on are guaranteed to be in memory (None = everything is).
+    def __init__(self, loaded_from: int = None):
+        self.timestamps = array("q")
+        self.prices = array("d")
+        self.loaded_from = loaded_from
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def trimBefore(self, ts: int):
+        index = bisect_left(self.timestamps, ts)
+        if index:
+            del self.timestamps[:index]
+            del self.prices[:index]
+        self.loaded_from = ts if self.loaded_from is None else max(self.loaded_from, ts)
+
+    def trimFrom(self, ts: int):
+        # Drops the entries at or after ts
+        index = bisect_left(self.timestamps, ts)
+        del self.timestamps[index:]
+        del self.prices[index:]
+
+    def add(self, ts: int, price: float):
+        if not self.timestamps or ts >= self.timestamps[-1]:
+            self.timestamps.append(ts)
+            self.prices.append(price)
+            return
+        # Out of order tick, keep the arrays sorted
+        index = bisect_right(self.timestamps, ts)
+        self.timestamps.insert(index, ts)
+        self.prices.insert(index, price)
+
+    def getLast(self):
+        if not self.timestamps:
+            return None
+        return self.timestamps[-1], self.prices[-1]
+
+    def getNearestIndex(self, ts: int, size: int = None) -> int:
+        # size limits the search to the first `size` entries
+        if size is None:
+            size = len(self.timestamps)
+        if size == 0:
+            return -1
+        index = bisect_left(self.timestamps, ts, 0, size)
+        if index == 0:
+            return 0
+        if index == size:
+            return size - 1
+        if self.timestamps[index] - ts < ts - self.timestamps[index - 1]:
+            return index
+        return index - 1
+
+    def getNearest(self, ts: int):
+        index = self.getNearestIndex(ts)
+        if index < 0:
+            return None
+        return self.timestamps[index], self.prices[index]
+
+
+class SlidingWindowExtremes:
+    # Max/min price over the last `window` seconds, kept in monotonic deques of (ts, price).
+    # Ticks must be pushed in time order.
+    def __init__(self, window: int):
+        self.window = window
+        self.max_entries = deque()
+        self.min_entries = deque()
+
+    @classmethod
+    def fromHistory(cls, history: PriceHistory, window: int, now_ts: int):
+        tracker = cls(window)
+        start = bisect_right(history.timestamps, now_ts - window)
+        for index in range(start, len(history)):
+            tracker.push(history.timestamps[index], history.prices[index])
+        return tracker
+
+    def push(self, ts: int, price: float):
+        while self.max_entries and self.max_entries[-1][1] <= price:
+            self.max_entries.pop()
+        self.max_entries.append((ts, price))
+        while self.min_entries and self.min_entries[-1][1] >= price:
+            self.min_entries.pop()
+        self.min_entries.append((ts, price))
+
+    def evict(self, now_ts: int):
+        # Entries are in the window while now - ts < window
+        cutoff = now_ts - self.window
+        while self.max_entries and self.max_entries[0][0] <= cutoff:
+            self.max_entries.popleft()
+        while self.min_entries and self.min_entries[0][0] <= cutoff:
+            self.min_entries.popleft()
+
+    def getMax(self):
+        return self.max_entries[0][1] if self.max_entries else None
+
+    def getMin(self):
+        return self.min_entries[0][1] if self.min_entries else None
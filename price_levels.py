@@ -0,0 +1,98 @@
+import os
+import time
+from bisect import bisect_left, bisect_right
+import orjson as json
+
+
+class PriceLevelIndex:
+    # Sorted price levels per symbol, loaded from a JSON file and swapped in whole when its mtime changes
+    def __init__(self, path: str = "price_levels.json", check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.levels = {}
+        self.mtime = None
+        self.next_check = 0.0
+
+    def load(self):
+        price_levels = json.loads(open(self.path, "r").read())
+        return {symbol: tuple(sorted(float(level) for level in levels))
+                for symbol, levels in price_levels.items()}
+
+    def reloadIfChanged(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.check_interval
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        try:
+            levels = self.load() if mtime is not None else {}
+        except (OSError, ValueError) as e:
+            # Probably caught mid-write, keep the old levels and retry on next check
+            print(f"Could not load {self.path}: {e}")
+            return
+        self.levels = levels
+        self.mtime = mtime
+
+    def getLevels(self, symbol: str):
+        self.reloadIfChanged()
+        return self.levels.get(symbol, ())
+
+
+class PriceLevelCrossingDetector:
+    # Remembers per (symbol, level) whether the price is inside the level's band and which side it came in
+    # from. Alerts when the price enters a band, leaves it on the other side or jumps over a level. Leaving a
+    # band needs band * (1 + hysteresis) distance and the same (symbol, level) does not alert again before
+    # cooldown seconds pass. The state lives in a state backend (state.py), with the Redis one all coordinator
+    # workers share it.
+    def __init__(self, index: PriceLevelIndex, state, band: float = 0.015, hysteresis: float = 0.5,
+                 cooldown: int = 900):
+        self.index = index
+        self.state = state
+        self.band = band
+        self.exit_band = band * (1 + hysteresis)
+        self.cooldown = cooldown
+
+    def update(self, symbol: str, price: float, ts: int):
+        # Returns a list of (level, event), event being "entered", "crossed_up" or "crossed_down"
+        levels = self.index.getLevels(symbol)
+        if not levels:
+            return []
+        last_price, was_inside = self.state.swapLevelState(symbol, price)
+        # Levels left behind, or gone since the levels were reloaded
+        left = [level for level in was_inside if level not in levels or abs(price / level - 1) >= self.exit_band]
+        events = []
+        if left:
+            # Only the worker that removed a level reports leaving it
+            for level in self.state.removeInsideLevels(symbol, left):
+                if level not in levels:
+                    continue
+                if was_inside[level] == "below" and price > level:
+                    events.append((level, "crossed_up"))
+                elif was_inside[level] == "above" and price < level:
+                    events.append((level, "crossed_down"))
+        inside = set(was_inside).difference(left)
+
+        index = bisect_left(levels, price)
+        for level in levels[max(index - 1, 0):index + 1]:
+            if level not in inside and abs(price / level - 1) < self.band:
+                inside.add(level)
+                side = "below" if (last_price if last_price is not None else price) < level else "above"
+                # Another worker may have seen a tick inside the band first
+                if self.state.addInsideLevel(symbol, level, side):
+                    events.append((level, "entered"))
+
+        if last_price is not None and last_price != price:
+            # Levels strictly between the last and current price were jumped over
+            low, high = min(last_price, price), max(last_price, price)
+            event = "crossed_up" if price > last_price else "crossed_down"
+            for level in levels[bisect_right(levels, low):bisect_left(levels, high)]:
+                if level not in inside and level not in was_inside:
+                    events.append((level, event))
+
+        return [(level, event) for level, event in events
+                if self.state.claimAlert(f"level:{symbol}:{level!r}", 1.0, ts, self.cooldown)]
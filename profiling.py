@@ -0,0 +1,207 @@
+import cProfile
+import io
+import marshal
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# On-demand profiling of the ingest endpoints (the /admin routes in main.py). While no session is running the
+# endpoints only check Profiler.session for None, nothing is hooked into the interpreter.
+
+
+def getStackKey(frame) -> str:
+    # Collapsed stack, root first: "main.py:addTokenToCheck;models.py:addPriceEntry;..."
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    # mode "cprofile": deterministic, every call of the profiled requests is traced (slows them down a lot).
+    # mode "sampling": the stack of the request is taken every `interval` seconds of CPU time while a profiled
+    # request runs, requests themselves run at full speed. Started on the main thread (uvicorn runs the app
+    # there) a SIGPROF timer interrupts the request itself. Elsewhere a sampler thread reads the request
+    # thread's frame, the switch interval is lowered for the session so that thread gets the GIL in time.
+    def __init__(self, mode: str, seconds: float, max_requests: int, interval: float):
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        self.mode = mode
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds
+        self.max_requests = max_requests
+        self.interval = interval
+        self.requests = 0
+        self.finished = None
+        self.profile = cProfile.Profile() if mode == "cprofile" else None
+        # Collapsed stack -> samples
+        self.stacks = Counter()
+        self.request_thread_id = None
+        self.in_request = False
+        self.sampler = None
+        self.previous_handler = None
+        self.timer_running = False
+        self.switch_interval = None
+
+    def start(self):
+        if self.mode != "sampling":
+            return
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "setitimer"):
+            self.previous_handler = signal.signal(signal.SIGPROF, self.onTimer)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            self.timer_running = True
+        else:
+            self.switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(min(self.switch_interval, self.interval / 10))
+            self.sampler = threading.Thread(target=self.sample, name="profiler-sampler", daemon=True)
+            self.sampler.start()
+
+    def isDone(self) -> bool:
+        return self.finished is not None or self.requests >= self.max_requests or time.monotonic() >= self.deadline
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.monotonic()
+        if self.timer_running:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self.timer_running = False
+        if self.previous_handler is not None and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGPROF, self.previous_handler)
+            self.previous_handler = None
+        if self.sampler is not None and self.sampler is not threading.current_thread():
+            self.sampler.join()
+        if self.switch_interval is not None:
+            sys.setswitchinterval(self.switch_interval)
+            self.switch_interval = None
+
+    def call(self, function, *args):
+        self.requests += 1
+        if self.profile is not None:
+            return self.profile.runcall(function, *args)
+        self.request_thread_id = threading.get_ident()
+        self.in_request = True
+        try:
+            return function(*args)
+        finally:
+            self.in_request = False
+
+    def onTimer(self, _signum, frame):
+        # SIGPROF handler, runs on the main thread with the frame it interrupted
+        if self.finished is not None or time.monotonic() >= self.deadline:
+            # Nobody ended the session, no point in interrupting the process any longer
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self.timer_running = False
+            return
+        if not self.in_request:
+            return
+        if self.request_thread_id != threading.main_thread().ident:
+            frame = sys._current_frames().get(self.request_thread_id)
+        if frame is not None:
+            self.stacks[getStackKey(frame)] += 1
+
+    def sample(self):
+        while self.finished is None and time.monotonic() < self.deadline:
+            time.sleep(self.interval)
+            if not self.in_request:
+                continue
+            frame = sys._current_frames().get(self.request_thread_id)
+            if frame is not None:
+                self.stacks[getStackKey(frame)] += 1
+
+    def getStatus(self) -> dict:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return {"mode": self.mode, "running": self.finished is None, "requests": self.requests,
+                "max_requests": self.max_requests, "seconds": round(end - self.started, 3),
+                "seconds_left": round(max(0.0, self.deadline - time.monotonic()), 3) if self.finished is None else 0,
+                "samples": sum(self.stacks.values())}
+
+    def getText(self, sort: str = "cumulative", limit: int = 50) -> str:
+        if self.profile is None:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def getBinary(self) -> bytes:
+        # Same format as pstats.Stats.dump_stats, loadable by pstats/snakeviz
+        if self.profile is None:
+            raise ValueError("Only cprofile sessions have a pstats dump")
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+
+class Profiler:
+    # One session at a time. The finished session is kept for its dump until the next one starts.
+    def __init__(self):
+        self.session = None
+        self.last = None
+
+    def start(self, mode: str, seconds: float, max_requests: int, interval: float) -> ProfileSession:
+        # A session past its deadline or request limit is only reaped on the next request or read
+        self.getLast()
+        if self.session is not None:
+            raise RuntimeError("A profiling session is already running")
+        session = ProfileSession(mode, seconds, max_requests, interval)
+        session.start()
+        self.session = session
+        self.last = session
+        return session
+
+    def stop(self):
+        session, self.session = self.session, None
+        if session is not None:
+            session.finish()
+        return self.last
+
+    def run(self, function, *args):
+        session = self.session
+        try:
+            return session.call(function, *args)
+        finally:
+            if session.isDone():
+                self.stop()
+
+    def getLast(self):
+        # Sessions also end on their deadline without any requests coming in
+        if self.session is not None and self.session.isDone():
+            self.stop()
+        return self.last
+
+
+class MemoryTracer:
+    # tracemalloc is only switched on by the first snapshot request, every later one also shows what grew
+    # since the previous snapshot
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.previous = None
+
+    def snapshot(self, limit: int = 25, key_type: str = "lineno") -> str:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = None
+            return "tracemalloc started, request again for a snapshot\n"
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Traced memory: {current / 2 ** 20:.1f} MB, peak {peak / 2 ** 20:.1f} MB", "",
+                 f"Top {limit} by {key_type}:"]
+        lines.extend(str(stat) for stat in snapshot.statistics(key_type)[:limit])
+        if self.previous is not None:
+            lines.extend(["", f"Top {limit} changes since the previous snapshot:"])
+            lines.extend(str(stat) for stat in snapshot.compare_to(self.previous, key_type)[:limit])
+        self.previous = snapshot
+        return "\n".join(lines) + "\n"
+
+    def stop(self):
+        self.previous = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
@@ -0,0 +1,200 @@
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import text
+from price_history import toEpoch
+
+# Candle intervals in seconds, each one is rolled up from the one before it (1m from raw ticks)
+CANDLE_INTERVALS = (60, 300, 3600, 86400)
+
+
+def aggregateTicks(rows, interval: int):
+    # rows: (ts, price) sorted by ts -> [bucket ts, open, high, low, close]
+    candles = []
+    current = None
+    for ts, price in rows:
+        bucket = ts - ts % interval
+        if current is None or current[0] != bucket:
+            current = [bucket, price, price, price, price]
+            candles.append(current)
+        else:
+            if price > current[2]:
+                current[2] = price
+            if price < current[3]:
+                current[3] = price
+            current[4] = price
+    return candles
+
+
+def aggregateCandles(rows, interval: int):
+    # rows: (ts, open, high, low, close) sorted by ts -> candles of a longer interval
+    candles = []
+    current = None
+    for ts, _open, high, low, close in rows:
+        bucket = ts - ts % interval
+        if current is None or current[0] != bucket:
+            current = [bucket, _open, high, low, close]
+            candles.append(current)
+        else:
+            if high > current[2]:
+                current[2] = high
+            if low < current[3]:
+                current[3] = low
+            current[4] = close
+    return candles
+
+
+class RollupJob:
+    # Background thread that rolls raw token_prices into 1m/5m/1h/1d OHLC candles and applies retention.
+    # Only complete buckets (older than `lag`) are rolled up, progress is kept per interval in rollup_state.
+    # Work is split into chunks of chunk_seconds per transaction with a pause in between, so the writer
+    # and the API never wait long on the database.
+    def __init__(self, engine, candle_tables: dict, run_every: float = 60.0, lag: int = 120,
+                 chunk_seconds: int = 3600, raw_retention_days: int = 0, candle_retention_days: dict = None,
+                 batch_size: int = 5000, pause: float = 0.05):
+        self.engine = engine
+        self.candle_tables = candle_tables
+        self.run_every = run_every
+        self.lag = lag
+        self.chunk_seconds = chunk_seconds
+        self.raw_retention_days = raw_retention_days
+        self.candle_retention_days = candle_retention_days or {}
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stats = {"candles": 0, "deleted_prices": 0, "deleted_candles": 0, "runs": 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="rollups", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        # First run only after run_every, to stay out of the way of startup
+        while not self.stopping.wait(self.run_every):
+            try:
+                self.runOnce(toEpoch(datetime.now()))
+            except Exception as e:
+                print(f"Rollup failed: {e}")
+
+    def runOnce(self, now_ts: int):
+        for interval in CANDLE_INTERVALS:
+            self.rollup(interval, now_ts)
+        self.applyRetention(now_ts)
+        self.stats["runs"] += 1
+
+    def getTokenIds(self):
+        with self.engine.connect() as connection:
+            return [row[0] for row in connection.exec_driver_sql("SELECT id FROM tokens")]
+
+    def getWatermark(self, interval: int):
+        with self.engine.connect() as connection:
+            row = connection.execute(text("SELECT watermark FROM rollup_state WHERE interval = :interval"),
+                                     {"interval": interval}).fetchone()
+        return row[0] if row is not None else None
+
+    def getSource(self, interval: int):
+        # (table name, columns) the candles of this interval are built from
+        index = CANDLE_INTERVALS.index(interval)
+        if index == 0:
+            return "token_prices", "ts, price"
+        return self.candle_tables[CANDLE_INTERVALS[index - 1]].name, "ts, open, high, low, close"
+
+    def getEarliestTs(self, source: str, token_ids):
+        earliest = None
+        with self.engine.connect() as connection:
+            for token_id in token_ids:
+                ts = connection.exec_driver_sql(f"SELECT MIN(ts) FROM {source} WHERE token_id = ?",
+                                                (token_id,)).scalar()
+                if ts is not None and (earliest is None or ts < earliest):
+                    earliest = ts
+        return earliest
+
+    def rollup(self, interval: int, now_ts: int):
+        end = now_ts - self.lag
+        if interval != CANDLE_INTERVALS[0]:
+            # A candle is complete only once all of its source candles are
+            source_watermark = self.getWatermark(CANDLE_INTERVALS[CANDLE_INTERVALS.index(interval) - 1])
+            if source_watermark is None:
+                return
+            end = min(end, source_watermark)
+        end -= end % interval
+        source, columns = self.getSource(interval)
+        token_ids = self.getTokenIds()
+        start = self.getWatermark(interval)
+        if start is None:
+            start = self.getEarliestTs(source, token_ids)
+            if start is None:
+                return
+            start -= start % interval
+        table = self.candle_tables[interval].name
+        chunk = max(self.chunk_seconds - self.chunk_seconds % interval, interval)
+        while start < end and not self.stopping.is_set():
+            chunk_end = min(start + chunk, end)
+            # Read and aggregate first, the write transaction only holds the lock for the inserts
+            rows_to_insert = []
+            with self.engine.connect() as connection:
+                for token_id in token_ids:
+                    rows = connection.exec_driver_sql(
+                        f"SELECT {columns} FROM {source} WHERE token_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                        (token_id, start, chunk_end)).fetchall()
+                    if not rows:
+                        continue
+                    if source == "token_prices":
+                        candles = aggregateTicks(rows, interval)
+                    else:
+                        candles = aggregateCandles(rows, interval)
+                    rows_to_insert.extend((token_id, *candle) for candle in candles)
+            with self.engine.begin() as connection:
+                if rows_to_insert:
+                    connection.exec_driver_sql(
+                        f"INSERT OR REPLACE INTO {table} (token_id, ts, open, high, low, close) "
+                        f"VALUES (?, ?, ?, ?, ?, ?)", rows_to_insert)
+                connection.execute(text("INSERT OR REPLACE INTO rollup_state (interval, watermark) "
+                                        "VALUES (:interval, :watermark)"),
+                                   {"interval": interval, "watermark": chunk_end})
+            self.stats["candles"] += len(rows_to_insert)
+            start = chunk_end
+            time.sleep(self.pause)
+
+    def deleteInBatches(self, table: str, cutoff_ts: int):
+        deleted = 0
+        for token_id in self.getTokenIds():
+            while not self.stopping.is_set():
+                with self.engine.begin() as connection:
+                    result = connection.exec_driver_sql(
+                        f"DELETE FROM {table} WHERE id IN "
+                        f"(SELECT id FROM {table} WHERE token_id = ? AND ts < ? LIMIT ?)",
+                        (token_id, cutoff_ts, self.batch_size))
+                deleted += result.rowcount
+                if result.rowcount < self.batch_size:
+                    break
+                time.sleep(self.pause)
+        return deleted
+
+    def applyRetention(self, now_ts: int):
+        if self.raw_retention_days:
+            # Raw ticks are only dropped once they are in the 1m candles
+            watermark = self.getWatermark(CANDLE_INTERVALS[0])
+            if watermark is not None:
+                cutoff_ts = min(now_ts - self.raw_retention_days * 86400, watermark)
+                self.stats["deleted_prices"] += self.deleteInBatches("token_prices", cutoff_ts)
+        for interval, days in self.candle_retention_days.items():
+            if not days:
+                continue
+            cutoff_ts = now_ts - days * 86400
+            index = CANDLE_INTERVALS.index(interval)
+            if index + 1 < len(CANDLE_INTERVALS):
+                # Keep candles the next interval was not built from yet
+                watermark = self.getWatermark(CANDLE_INTERVALS[index + 1])
+                if watermark is None:
+                    continue
+                cutoff_ts = min(cutoff_ts, watermark)
+            self.stats["deleted_candles"] += self.deleteInBatches(self.candle_tables[interval].name, cutoff_ts)
@@ -0,0 +1,102 @@
+import hashlib
+import statistics
+from bisect import bisect_right
+
+
+def hashKey(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # Consistent hash ring, every node gets replicas * weight virtual nodes. Adding, removing or
+    # re-weighting a node only moves the keys of the ring segments that changed owner.
+    def __init__(self, replicas: int = 100):
+        self.replicas = replicas
+        self.weights = {}
+        self.hashes = []
+        self.nodes = []
+
+    def setNodes(self, weights: dict):
+        # weights: node -> weight
+        if weights == self.weights:
+            return
+        self.weights = dict(weights)
+        points = []
+        for node, weight in weights.items():
+            for replica in range(max(1, round(self.replicas * weight))):
+                points.append((hashKey(f"{node}#{replica}"), node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def getNode(self, key: str):
+        if not self.nodes:
+            return None
+        index = bisect_right(self.hashes, hashKey(key))
+        return self.nodes[index % len(self.nodes)]
+
+
+class ShardManager:
+    # Assigns symbols to grabbers over a HashRing. Grabbers that failed max_failures checks in a row are
+    # left out of the ring (their symbols move to the others in the same cycle) until they answer again.
+    # Grabbers don't report their load, so the latency of their /getTokens answer (EWMA) is used instead:
+    # weight = median latency / own latency, both plus latency_floor so differences of a few ms between fast
+    # grabbers don't count, clamped and rounded to weight_step so noise doesn't move symbols.
+    def __init__(self, urls, replicas: int = 100, max_failures: int = 1, smoothing: float = 0.3,
+                 min_weight: float = 0.5, max_weight: float = 2.0, weight_step: float = 0.25,
+                 latency_floor: float = 0.05):
+        self.urls = list(urls)
+        self.ring = HashRing(replicas)
+        self.max_failures = max_failures
+        self.smoothing = smoothing
+        self.min_weight = min_weight
+        self.max_weight = max_weight
+        self.weight_step = weight_step
+        self.latency_floor = latency_floor
+        self.grabbers = {url: {"failures": 0, "latency": None} for url in self.urls}
+
+    def isAlive(self, url: str) -> bool:
+        return self.grabbers[url]["failures"] < self.max_failures
+
+    def reportSuccess(self, url: str, latency: float):
+        grabber = self.grabbers[url]
+        if not self.isAlive(url):
+            print(f"Grabber {url} is back")
+        grabber["failures"] = 0
+        if grabber["latency"] is None:
+            grabber["latency"] = latency
+        else:
+            grabber["latency"] += self.smoothing * (latency - grabber["latency"])
+
+    def reportFailure(self, url: str):
+        was_alive = self.isAlive(url)
+        self.grabbers[url]["failures"] += 1
+        if was_alive and not self.isAlive(url):
+            print(f"Grabber {url} is down, moving its symbols")
+
+    def getWeights(self) -> dict:
+        alive = [url for url in self.urls if self.isAlive(url)]
+        latencies = [self.grabbers[url]["latency"] for url in alive if self.grabbers[url]["latency"] is not None]
+        if not latencies:
+            return {url: 1.0 for url in alive}
+        median = statistics.median(latencies)
+        weights = {}
+        for url in alive:
+            latency = self.grabbers[url]["latency"]
+            if latency is None:
+                weight = 1.0
+            else:
+                weight = (median + self.latency_floor) / (latency + self.latency_floor)
+            weight = min(self.max_weight, max(self.min_weight, weight))
+            weights[url] = round(weight / self.weight_step) * self.weight_step
+        return weights
+
+    def assign(self, symbols) -> dict:
+        # -> url: set of symbols, only alive grabbers are in it
+        self.ring.setNodes(self.getWeights())
+        assignment = {url: set() for url in self.ring.weights}
+        for symbol in symbols:
+            url = self.ring.getNode(symbol)
+            if url is not None:
+                assignment[url].add(symbol)
+        return assignment
@@ -0,0 +1,301 @@
+from bisect import bisect_right
+from price_history import PriceHistory
+
+# Hot state of the alert evaluation shared by coordinator workers: each symbol's (ts, price) series over the
+# last `retention` seconds, the price level crossing state and alert cooldowns. tools/check_state_backends.py
+# runs the same checks against every backend.
+
+
+class StateBackend:
+    def addPrice(self, symbol: str, ts: int, price: float):
+        raise NotImplementedError
+
+    def addPrices(self, symbol: str, entries):
+        # entries: iterable of (ts, price)
+        for ts, price in entries:
+            self.addPrice(symbol, ts, price)
+
+    def getLast(self, symbol: str):
+        # (ts, price) of the newest entry, or None
+        raise NotImplementedError
+
+    def getNearest(self, symbol: str, ts: int):
+        # (ts, price) of the entry closest to ts (the older one on a tie), or None. Which of several entries
+        # with the same ts is returned is not specified.
+        raise NotImplementedError
+
+    def getWindows(self, symbol: str, windows, now_ts: int):
+        # For each window length: ((ts, price) nearest to now - window or None, max, min), max/min over the
+        # entries with now - window < ts, None if there are none
+        raise NotImplementedError
+
+    def swapLevelState(self, symbol: str, price: float):
+        # Stores price as the symbol's last price seen by the price level detector.
+        # -> (previous price or None, {level the price was inside: side it entered from, "below" or "above"})
+        raise NotImplementedError
+
+    def addInsideLevel(self, symbol: str, level: float, side: str) -> bool:
+        # False if the level was already marked inside (e.g. by another worker)
+        raise NotImplementedError
+
+    def removeInsideLevels(self, symbol: str, levels):
+        # -> the levels that were inside and got removed by this call
+        raise NotImplementedError
+
+    def claimAlert(self, key: str, significance: float, now_ts: int, cooldown: float) -> bool:
+        # True if key was not claimed within the last cooldown seconds with the same or a higher significance,
+        # the claim is recorded then. Only one of several workers claiming the same alert gets True.
+        raise NotImplementedError
+
+
+class MemoryStateBackend(StateBackend):
+    # Single process reference implementation
+    def __init__(self, retention: int):
+        self.retention = retention
+        self.histories = {}
+        # symbol -> last price, symbol -> {level: side entered from}
+        self.level_prices = {}
+        self.inside_levels = {}
+        # key -> (ts the claim expires, significance)
+        self.claims = {}
+
+    def addPrice(self, symbol: str, ts: int, price: float):
+        history = self.histories.get(symbol)
+        if history is None:
+            history = PriceHistory()
+            self.histories[symbol] = history
+        history.add(ts, price)
+        if history.timestamps[0] <= ts - self.retention:
+            history.trimBefore(ts - self.retention + 1)
+
+    def getLast(self, symbol: str):
+        history = self.histories.get(symbol)
+        return history.getLast() if history is not None else None
+
+    def getNearest(self, symbol: str, ts: int):
+        history = self.histories.get(symbol)
+        return history.getNearest(ts) if history is not None else None
+
+    def getWindows(self, symbol: str, windows, now_ts: int):
+        history = self.histories.get(symbol)
+        results = []
+        for window in windows:
+            if history is None:
+                results.append((None, None, None))
+                continue
+            start = bisect_right(history.timestamps, now_ts - window)
+            prices = history.prices[start:]
+            results.append((history.getNearest(now_ts - window),
+                            max(prices) if prices else None, min(prices) if prices else None))
+        return results
+
+    def swapLevelState(self, symbol: str, price: float):
+        previous = self.level_prices.get(symbol)
+        self.level_prices[symbol] = price
+        return previous, dict(self.inside_levels.get(symbol, {}))
+
+    def addInsideLevel(self, symbol: str, level: float, side: str) -> bool:
+        inside = self.inside_levels.setdefault(symbol, {})
+        if level in inside:
+            return False
+        inside[level] = side
+        return True
+
+    def removeInsideLevels(self, symbol: str, levels):
+        inside = self.inside_levels.get(symbol, {})
+        return [level for level in levels if inside.pop(level, None) is not None]
+
+    def claimAlert(self, key: str, significance: float, now_ts: int, cooldown: float) -> bool:
+        claim = self.claims.get(key)
+        if claim is not None and now_ts < claim[0] and significance <= claim[1]:
+            return False
+        self.claims[key] = (now_ts + cooldown, significance)
+        if len(self.claims) > 10000:
+            self.claims = {key: claim for key, claim in self.claims.items() if now_ts < claim[0]}
+        return True
+
+
+class RedisStateBackend(StateBackend):
+    # Per symbol:
+    #   {prefix}{symbol}:ticks           sorted set of "ts:price", scored by ts
+    #   {prefix}{symbol}:minutes:{hour}  sorted set of "{minute}:high" / "{minute}:low" scored by the highest
+    #                                    (ZADD GT) / lowest (ZADD LT) price of each minute of that hour
+    #   {prefix}{symbol}:hours:{day}     same per hour of that day
+    #   {prefix}{symbol}:level_price     last price seen by the price level detector (SET GET)
+    #   {prefix}{symbol}:inside          hash of the levels the price is inside -> side it entered from
+    #                                    (HSETNX tells who entered first)
+    # Per alert key:
+    #   {prefix}claims:{key}    sorted set with one member scored by the significance (ZADD GT CH), expiring
+    #                           after the cooldown
+    # Every update is a single atomic command, so any number of workers can write the same symbol. Window
+    # max/min comes from the whole hours, the whole minutes of the hour the window starts in and the raw ticks
+    # of the minute it starts in, all windows of a tick in one round trip. What is read per tick depends on
+    # the windows, not on how much history is kept. Bucket keys expire once they are older than retention.
+    def __init__(self, client, retention: int, prefix: str = "prices:"):
+        self.client = client
+        self.retention = retention
+        self.prefix = prefix
+
+    def getTicksKey(self, symbol: str) -> str:
+        return f"{self.prefix}{symbol}:ticks"
+
+    def getMinutesKey(self, symbol: str, hour: int) -> str:
+        return f"{self.prefix}{symbol}:minutes:{hour}"
+
+    def getHoursKey(self, symbol: str, day: int) -> str:
+        return f"{self.prefix}{symbol}:hours:{day}"
+
+    @staticmethod
+    def parseEntry(member, score):
+        if isinstance(member, bytes):
+            member = member.decode()
+        return int(score), float(member.split(":", 1)[1])
+
+    @staticmethod
+    def parseBuckets(entries, buckets: dict):
+        # ["{bucket}:high" / "{bucket}:low", price] -> buckets {bucket: [high, low]}
+        for member, price in entries:
+            if isinstance(member, bytes):
+                member = member.decode()
+            bucket, kind = member.split(":")
+            buckets.setdefault(int(bucket), [None, None])[0 if kind == "high" else 1] = price
+        return buckets
+
+    def addPrice(self, symbol: str, ts: int, price: float):
+        self.addPrices(symbol, [(ts, price)])
+
+    def addPrices(self, symbol: str, entries):
+        ticks_key = self.getTicksKey(symbol)
+        ticks = {}
+        # key -> {member: price}, the highs and lows of the entries per bucket
+        highs = {}
+        lows = {}
+        for ts, price in entries:
+            ticks[f"{ts}:{price!r}"] = ts
+            minute, hour = ts // 60, ts // 3600
+            for key, bucket in ((self.getMinutesKey(symbol, hour), minute),
+                                (self.getHoursKey(symbol, ts // 86400), hour)):
+                key_highs = highs.setdefault(key, {})
+                key_lows = lows.setdefault(key, {})
+                high, low = f"{bucket}:high", f"{bucket}:low"
+                key_highs[high] = max(price, key_highs.get(high, price))
+                key_lows[low] = min(price, key_lows.get(low, price))
+        if not ticks:
+            return
+        newest_ts = max(ticks.values())
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.zadd(ticks_key, ticks)
+        pipeline.zremrangebyscore(ticks_key, "-inf", newest_ts - self.retention)
+        # Symbols nobody sends anymore disappear on their own
+        pipeline.expire(ticks_key, self.retention * 2)
+        for key in highs:
+            pipeline.zadd(key, highs[key], gt=True)
+            pipeline.zadd(key, lows[key], lt=True)
+            # Until the newest bucket in the key is older than retention
+            pipeline.expire(key, self.retention + (3600 if ":minutes:" in key else 86400))
+        pipeline.execute()
+
+    def getLast(self, symbol: str):
+        entries = self.client.zrevrange(self.getTicksKey(symbol), 0, 0, withscores=True)
+        return self.parseEntry(*entries[0]) if entries else None
+
+    def queueNearest(self, pipeline, ticks_key: str, ts: int):
+        pipeline.zrevrangebyscore(ticks_key, ts, "-inf", start=0, num=1, withscores=True)
+        pipeline.zrangebyscore(ticks_key, ts, "+inf", start=0, num=1, withscores=True)
+
+    def pickNearest(self, ts: int, before, after):
+        before = self.parseEntry(*before[0]) if before else None
+        after = self.parseEntry(*after[0]) if after else None
+        if before is None or (after is not None and after[0] - ts < ts - before[0]):
+            return after
+        return before
+
+    def getNearest(self, symbol: str, ts: int):
+        pipeline = self.client.pipeline(transaction=False)
+        self.queueNearest(pipeline, self.getTicksKey(symbol), ts)
+        return self.pickNearest(ts, *pipeline.execute())
+
+    def getWindows(self, symbol: str, windows, now_ts: int):
+        ticks_key = self.getTicksKey(symbol)
+        # (cutoff, first whole minute, first whole hour) of each window, entries with ts > cutoff are in it
+        bounds = []
+        for window in windows:
+            cutoff = now_ts - window
+            first_minute = (cutoff + 1 + 59) // 60
+            bounds.append((cutoff, first_minute, (first_minute + 59) // 60))
+        # The minutes of the hour before the first whole hour, days from the oldest first whole hour on
+        # (one more for ticks stamped ahead of now)
+        hours = sorted({first_hour - 1 for _, first_minute, first_hour in bounds if first_minute % 60})
+        days = range(min(first_hour for _, _, first_hour in bounds) // 24, now_ts // 86400 + 2)
+        pipeline = self.client.pipeline(transaction=False)
+        for hour in hours:
+            pipeline.zrange(self.getMinutesKey(symbol, hour), 0, -1, withscores=True)
+        for day in days:
+            pipeline.zrange(self.getHoursKey(symbol, day), 0, -1, withscores=True)
+        for cutoff, first_minute, _ in bounds:
+            self.queueNearest(pipeline, ticks_key, cutoff)
+            # Ticks of the minute the window starts in, if it doesn't start on a whole minute
+            pipeline.zrangebyscore(ticks_key, f"({cutoff}", f"({first_minute * 60}", withscores=True)
+        replies = pipeline.execute()
+        minute_buckets = {}
+        for entries in replies[:len(hours)]:
+            self.parseBuckets(entries, minute_buckets)
+        hour_buckets = {}
+        for entries in replies[len(hours):len(hours) + len(days)]:
+            self.parseBuckets(entries, hour_buckets)
+        window_replies = replies[len(hours) + len(days):]
+        results = []
+        for index, (cutoff, first_minute, first_hour) in enumerate(bounds):
+            before, after, edge_ticks = window_replies[index * 3:index * 3 + 3]
+            buckets = [value for hour, value in hour_buckets.items() if hour >= first_hour]
+            buckets.extend(value for minute, value in minute_buckets.items()
+                           if first_minute <= minute < first_hour * 60)
+            edge_prices = [self.parseEntry(member, score)[1] for member, score in edge_ticks]
+            window_max = max([high for high, _ in buckets if high is not None] + edge_prices, default=None)
+            window_min = min([low for _, low in buckets if low is not None] + edge_prices, default=None)
+            results.append((self.pickNearest(cutoff, before, after), window_max, window_min))
+        return results
+
+    def swapLevelState(self, symbol: str, price: float):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(f"{self.prefix}{symbol}:level_price", repr(price), get=True, ex=self.retention * 2)
+        pipeline.hgetall(f"{self.prefix}{symbol}:inside")
+        previous, inside = pipeline.execute()
+        return None if previous is None else float(previous), {float(level): side.decode()
+                                                               for level, side in inside.items()}
+
+    def addInsideLevel(self, symbol: str, level: float, side: str) -> bool:
+        key = f"{self.prefix}{symbol}:inside"
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hsetnx(key, repr(level), side)
+        pipeline.expire(key, self.retention * 2)
+        return pipeline.execute()[0] == 1
+
+    def removeInsideLevels(self, symbol: str, levels):
+        key = f"{self.prefix}{symbol}:inside"
+        pipeline = self.client.pipeline(transaction=False)
+        for level in levels:
+            pipeline.hdel(key, repr(level))
+        return [level for level, removed in zip(levels, pipeline.execute()) if removed]
+
+    def claimAlert(self, key: str, significance: float, now_ts: int, cooldown: float) -> bool:
+        # Expiry is on the Redis clock, now_ts is only used by the memory backend
+        if cooldown <= 0:
+            return True
+        key = f"{self.prefix}claims:{key}"
+        if not self.client.zadd(key, {"s": significance}, gt=True, ch=True):
+            return False
+        self.client.pexpire(key, max(1, int(cooldown * 1000)))
+        return True
+
+
+def createStateBackend(kind: str, retention: int, redis_url: str = "redis://localhost:6379"):
+    # "local" keeps the state inside each Token (single worker, fastest), None is returned for it
+    if kind == "local":
+        return None
+    if kind == "memory":
+        return MemoryStateBackend(retention)
+    if kind == "redis":
+        import redis
+        return RedisStateBackend(redis.from_url(redis_url), retention)
+    raise ValueError(f"Unknown state backend: {kind}")
@@ -0,0 +1,165 @@
+import numpy as np
+from price_history import timeFrameToSeconds
+
+# Bucket lengths in seconds, each window uses the shortest one that needs at most MAX_BUCKETS_PER_WINDOW
+BUCKET_RESOLUTIONS = (60, 300, 900, 3600)
+MAX_BUCKETS_PER_WINDOW = 96
+
+
+def resize(array, capacity: int, fill):
+    # Grows the last axis (symbols) to capacity
+    grown = np.full(array.shape[:-1] + (capacity,), fill, dtype=array.dtype)
+    grown[..., :array.shape[-1]] = array
+    return grown
+
+
+class BucketRing:
+    # Ring buffers of open/high/low/close per time bucket (buckets x symbols) for one resolution
+    def __init__(self, resolution: int, buckets: int, capacity: int):
+        self.resolution = resolution
+        self.buckets = buckets
+        self.bucket_ids = np.full((buckets, capacity), -1, dtype=np.int64)
+        self.opens = np.full((buckets, capacity), np.nan)
+        self.highs = np.full((buckets, capacity), np.nan)
+        self.lows = np.full((buckets, capacity), np.nan)
+        self.closes = np.full((buckets, capacity), np.nan)
+
+    def grow(self, capacity: int):
+        self.bucket_ids = resize(self.bucket_ids, capacity, -1)
+        self.opens = resize(self.opens, capacity, np.nan)
+        self.highs = resize(self.highs, capacity, np.nan)
+        self.lows = resize(self.lows, capacity, np.nan)
+        self.closes = resize(self.closes, capacity, np.nan)
+
+    def add(self, row: int, ts: int, price: float, newest: bool):
+        bucket = ts // self.resolution
+        slot = bucket % self.buckets
+        slot_bucket = self.bucket_ids[slot, row]
+        if slot_bucket == bucket:
+            if price > self.highs[slot, row]:
+                self.highs[slot, row] = price
+            if price < self.lows[slot, row]:
+                self.lows[slot, row] = price
+            if newest:
+                self.closes[slot, row] = price
+        elif slot_bucket < bucket:
+            self.bucket_ids[slot, row] = bucket
+            self.opens[slot, row] = self.highs[slot, row] = self.lows[slot, row] = self.closes[slot, row] = price
+        # else: older than the ring buffer
+
+    def evaluate(self, rows, now_ts: int, lengths):
+        # For windows of `lengths` buckets -> (window max, window min, reference ts, reference price), each
+        # (lengths x rows). Buckets are reordered by age first (index k = k buckets ago).
+        now_bucket = now_ts // self.resolution
+        ages = np.arange(self.buckets)
+        slots = (now_bucket - ages) % self.buckets
+        valid = self.bucket_ids.take(slots, axis=0)[:, rows] == (now_bucket - ages)[:, None]
+        # Max/min of every window length at once: running max/min from the newest bucket backwards
+        running_maxes = np.maximum.accumulate(np.where(valid, self.highs.take(slots, axis=0)[:, rows], -np.inf))
+        running_mins = np.minimum.accumulate(np.where(valid, self.lows.take(slots, axis=0)[:, rows], np.inf))
+        # Age of the oldest bucket with ticks up to k, and of the newest one from k on
+        oldest_up_to = np.maximum.accumulate(np.where(valid, ages[:, None], -1))
+        newest_from = np.minimum.accumulate(np.where(valid, ages[:, None], self.buckets)[::-1])[::-1]
+        # Reference: close of the newest bucket before the window, or the open of the oldest one in it
+        newest_before = newest_from[lengths]
+        oldest_in = oldest_up_to[lengths - 1]
+        has_before = newest_before < self.buckets
+        reference_ages = np.where(has_before, newest_before, np.maximum(oldest_in, 0))
+        reference_slots = (now_bucket - reference_ages) % self.buckets
+        references = np.where(has_before, self.closes[reference_slots, rows], self.opens[reference_slots, rows])
+        references[~has_before & (oldest_in < 0)] = np.nan
+        return (running_maxes[lengths - 1], running_mins[lengths - 1],
+                (now_bucket - reference_ages) * self.resolution, references)
+
+
+class SweepEvaluator:
+    # Alert evaluation of the whole market at once (EVALUATION_MODE=sweep). Ticks only update ring buffers of
+    # per-bucket open/high/low/close, sweep() then computes reference prices, window highs/lows, changes and
+    # ATH/ATL hits for every symbol with new ticks and every timeframe in a few array operations.
+    # Windows and reference times have bucket resolution (1 minute up to 1h windows, 1/96 of longer ones).
+    # A cell is only reported when it starts firing (or flips direction), not on every sweep it keeps firing.
+    def __init__(self, timeframes, capacity: int = 256):
+        # timeframes: [(time_frame, minimum change in %)]
+        self.timeframes = list(timeframes)
+        self.thresholds = np.array([threshold for _, threshold in self.timeframes], dtype=np.float64)
+        # resolution -> [(timeframe index, window length in buckets)]
+        self.windows = {}
+        for index, (time_frame, _) in enumerate(self.timeframes):
+            window = timeFrameToSeconds(time_frame)
+            resolution = next((resolution for resolution in BUCKET_RESOLUTIONS
+                               if window / resolution <= MAX_BUCKETS_PER_WINDOW), BUCKET_RESOLUTIONS[-1])
+            self.windows.setdefault(resolution, []).append((index, max(1, window // resolution)))
+        self.rings = {resolution: BucketRing(resolution, max(length for _, length in windows) + 1, capacity)
+                      for resolution, windows in self.windows.items()}
+        self.symbols = []
+        self.rows = {}
+        self.capacity = capacity
+        self.last_prices = np.full(capacity, np.nan)
+        self.last_ts = np.full(capacity, -1, dtype=np.int64)
+        self.updated = np.zeros(capacity, dtype=bool)
+        # +1 firing up, -1 firing down, 0 not firing, per timeframe and symbol
+        self.states = np.zeros((len(self.timeframes), capacity), dtype=np.int8)
+
+    def getRow(self, symbol: str) -> int:
+        row = self.rows.get(symbol)
+        if row is None:
+            if len(self.symbols) == self.capacity:
+                self.capacity *= 2
+                for ring in self.rings.values():
+                    ring.grow(self.capacity)
+                self.last_prices = resize(self.last_prices, self.capacity, np.nan)
+                self.last_ts = resize(self.last_ts, self.capacity, -1)
+                self.updated = resize(self.updated, self.capacity, False)
+                self.states = resize(self.states, self.capacity, 0)
+            row = len(self.symbols)
+            self.symbols.append(symbol)
+            self.rows[symbol] = row
+        return row
+
+    def add(self, symbol: str, ts: int, price: float, evaluate: bool = True):
+        # evaluate=False only fills the buffers (history loaded at startup)
+        row = self.getRow(symbol)
+        newest = ts >= self.last_ts[row]
+        for ring in self.rings.values():
+            ring.add(row, ts, price, newest)
+        if newest:
+            self.last_ts[row] = ts
+            self.last_prices[row] = price
+        if evaluate:
+            self.updated[row] = True
+
+    def sweep(self, now_ts: int):
+        # -> [(symbol, timeframe index, historic ts, historic price, window max, window min, price, ts)] of the
+        # cells that started firing
+        rows = np.flatnonzero(self.updated[:len(self.symbols)])
+        if rows.size == 0:
+            return []
+        self.updated[rows] = False
+        shape = (len(self.timeframes), rows.size)
+        window_maxes, window_mins, references = np.empty(shape), np.empty(shape), np.empty(shape)
+        reference_ts = np.empty(shape, dtype=np.int64)
+        for resolution, windows in self.windows.items():
+            indexes = [index for index, _ in windows]
+            lengths = np.array([length for _, length in windows])
+            (window_maxes[indexes], window_mins[indexes], reference_ts[indexes],
+             references[indexes]) = self.rings[resolution].evaluate(rows, now_ts, lengths)
+        prices = self.last_prices[rows]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            changes = prices / references * 100 - 100
+        thresholds = self.thresholds[:, None]
+        went_up = (prices > references) & (window_maxes <= prices) & (changes >= thresholds)
+        went_down = (prices < references) & (window_mins >= prices) & (-changes >= thresholds)
+        states = went_up.astype(np.int8) - went_down.astype(np.int8)
+        fired = (states != 0) & (states != self.states[:, rows])
+        self.states[:, rows] = states
+        results = []
+        for index, row_index in zip(*np.nonzero(fired)):
+            row = rows[row_index]
+            window_max = window_maxes[index, row_index]
+            window_min = window_mins[index, row_index]
+            results.append((self.symbols[row], int(index), int(reference_ts[index, row_index]),
+                            float(references[index, row_index]),
+                            float(window_max) if np.isfinite(window_max) else None,
+                            float(window_min) if np.isfinite(window_min) else None,
+                            float(prices[row_index]), int(self.last_ts[row])))
+        return results
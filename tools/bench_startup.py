@@ -0,0 +1,99 @@
+import argparse
+import calendar
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+# Startup time and peak RSS of Repository.initializeDB (windowed history load) compared to materializing
+# every TokenPrice through the ORM, which is what startup used to do.
+#   python tools/bench_startup.py --dir /tmp/bench --symbols 300 --days 30 --interval 10   (~3GB database)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generateDatabase(path: str, symbols: int, days: int, interval: int):
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("CREATE TABLE tokens (symbol VARCHAR UNIQUE, currency VARCHAR, id INTEGER NOT NULL PRIMARY KEY)")
+    connection.execute("CREATE TABLE token_prices (token_id INTEGER, price FLOAT, ts INTEGER, datetime VARCHAR, "
+                       "id INTEGER NOT NULL PRIMARY KEY, FOREIGN KEY(token_id) REFERENCES tokens (id))")
+    connection.executemany("INSERT INTO tokens (symbol, currency) VALUES (?, 'USD')",
+                           [(f"SYM{index}",) for index in range(symbols)])
+    # Same encoding as price_history.toEpoch: local wall clock time as if it were UTC
+    end_ts = calendar.timegm(datetime.now().timetuple())
+    start_ts = end_ts - days * 86400
+    prices = [random.uniform(0.01, 100) for _ in range(symbols)]
+    rows_written = 0
+    for ts in range(start_ts, end_ts, interval):
+        rows = []
+        for token_index in range(symbols):
+            prices[token_index] *= 1 + random.gauss(0, 0.001)
+            rows.append((token_index + 1, prices[token_index], ts))
+        connection.executemany("INSERT INTO token_prices (token_id, price, ts) VALUES (?, ?, ?)", rows)
+        rows_written += len(rows)
+        if rows_written % 1_000_000 < symbols:
+            connection.commit()
+            print(f"Generated {rows_written} rows", end="\r")
+    connection.execute("CREATE INDEX ix_token_prices_token_id_ts ON token_prices (token_id, ts)")
+    connection.commit()
+    connection.close()
+    print(f"\nGenerated {rows_written} rows, {os.path.getsize(path) / 2 ** 30:.2f} GB")
+
+
+def runFull():
+    from sqlalchemy.orm import sessionmaker
+    from models import Token, TokenPrice
+    from persistence import createEngine
+    session = sessionmaker(bind=createEngine("database.db"))()
+    prices = 0
+    for token in session.query(Token).all():
+        entries = session.query(TokenPrice).filter(TokenPrice.token_id == token.id).all()
+        prices += len([entry.getTimestamp() for entry in entries])
+    return prices
+
+
+def runWindowed():
+    from models import Repository
+    repo = Repository()
+    repo.initializeDB()
+    prices = sum(len(token.getPriceHistory()) for token in repo.tokens)
+    repo.rollups.stop()
+    repo.price_writer.stop()
+    return prices
+
+
+def measure(mode: str):
+    sys.path.insert(0, ROOT)
+    time_start = time.perf_counter()
+    prices = runFull() if mode == "full" else runWindowed()
+    elapsed = time.perf_counter() - time_start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode}: {prices} prices in memory, {elapsed:.2f}s, peak RSS {max_rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark coordinator startup against a synthetic database.db")
+    parser.add_argument("--dir", default="bench_startup")
+    parser.add_argument("--symbols", type=int, default=300)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--interval", type=int, default=10, help="seconds between ticks")
+    parser.add_argument("--skip-full", action="store_true", help="only measure the windowed load")
+    parser.add_argument("--measure", choices=["full", "windowed"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    os.chdir(args.dir)
+    if args.measure:
+        measure(args.measure)
+        sys.exit(0)
+    if not os.path.exists("database.db"):
+        generateDatabase("database.db", args.symbols, args.days, args.interval)
+    # Each mode in a fresh process so peak RSS is its own
+    for mode in (["windowed"] if args.skip_full else ["windowed", "full"]):
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--dir", ".", "--measure", mode], check=True)
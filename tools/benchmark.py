@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+import aiohttp
+import orjson as json
+from bench_startup import ROOT, generateDatabase
+
+# Ingest benchmark: a synthetic database with prior history, main.py in its own process with notifications
+# going to tools/webhook_sink.py, and random walk ticks replayed through /addTokenPrice or /addTokenPrices.
+#   python tools/benchmark.py --symbols 500 --days 2 --ticks 50000 --save-baseline baseline.json
+#   python tools/benchmark.py --symbols 500 --days 2 --ticks 50000 --baseline baseline.json
+# Extra environment for the coordinator (EVALUATION_MODE, STATE_BACKEND, ...) is passed through.
+
+# Metric -> True if higher is better
+METRICS = {
+    "ticks_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "alerts_per_second": True,
+    "webhook_messages_per_second": True,
+    "rss_mb": False,
+    "peak_rss_mb": False,
+    "db_growth_mb": False,
+}
+
+
+def getFreePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def getDatabaseSize(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if name.startswith("database.db"))
+
+
+def getProcessMemory(pid: int):
+    # (current RSS, peak RSS) in MB
+    values = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":")
+                values[key] = int(value.split()[0]) / 1024
+    return values.get("VmRSS", 0.0), values.get("VmHWM", 0.0)
+
+
+def getLastPrices(path: str, symbols: int):
+    # Newest price of SYM0..SYM{symbols - 1} in the template database, one index lookup per symbol
+    connection = sqlite3.connect(path)
+    try:
+        return [connection.execute("SELECT token_prices.price FROM token_prices JOIN tokens ON tokens.id = token_id "
+                                   "WHERE tokens.symbol = ? ORDER BY ts DESC LIMIT 1",
+                                   (f"SYM{index}",)).fetchone()[0]
+                for index in range(symbols)]
+    finally:
+        connection.close()
+
+
+def generateTicks(symbols: int, ticks: int, seed: int, start_prices=None):
+    # Round robin over the symbols, random walk prices with occasional jumps so alerts fire. The walk goes on
+    # from start_prices (the end of the generated history), otherwise a first tick would jump by the whole
+    # drift of the history.
+    random.seed(seed)
+    prices = list(start_prices) if start_prices is not None else [random.uniform(0.01, 100) for _ in range(symbols)]
+    for index in range(ticks):
+        token_index = index % symbols
+        step = random.gauss(0, 0.002)
+        if random.random() < 0.001:
+            step += random.choice([-1, 1]) * random.uniform(0.02, 0.1)
+        prices[token_index] = max(1e-6, prices[token_index] * (1 + step))
+        yield f"SYM{token_index}", round(prices[token_index], 8)
+
+
+async def waitForServer(session: aiohttp.ClientSession, url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode}")
+        try:
+            async with session.get(url) as response:
+                if response.status < 500:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+async def replay(session: aiohttp.ClientSession, base_url: str, ticks, mode: str, batch_size: int,
+                 concurrency: int):
+    # -> request latencies in seconds
+    if mode == "single":
+        requests = [("/addTokenPrice", {"symbol": symbol, "current_price": price}) for symbol, price in ticks]
+    else:
+        requests = [("/addTokenPrices", [{"symbol": symbol, "current_price": price}
+                                         for symbol, price in ticks[start:start + batch_size]])
+                    for start in range(0, len(ticks), batch_size)]
+    latencies = []
+    next_request = 0
+
+    async def sender():
+        nonlocal next_request
+        while next_request < len(requests):
+            path, payload = requests[next_request]
+            next_request += 1
+            # Stamped when sent, like a grabber does
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            if isinstance(payload, list):
+                for tick in payload:
+                    tick["current_time"] = current_time
+            else:
+                payload["current_time"] = current_time
+            time_start = time.perf_counter()
+            async with session.post(base_url + path, data=json.dumps(payload),
+                                    headers={"content-type": "application/json"}) as response:
+                await response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"{path} returned {response.status}")
+            latencies.append(time.perf_counter() - time_start)
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return latencies
+
+
+async def getAlertsTotal(session: aiohttp.ClientSession, base_url: str) -> float:
+    # coordinator_alerts_total over all types, alerts raised before the aggregator merges them into webhook
+    # messages (with EVALUATION_MODE=rq they are raised in the workers and not counted here)
+    async with session.get(base_url + "/metrics") as response:
+        text = await response.text()
+    return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines()
+               if line.startswith(("coordinator_alerts_total{", "coordinator_alerts_total ")))
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def runMode(args, template: str, mode: str) -> dict:
+    run_directory = os.path.join(args.dir, f"run_{mode}")
+    shutil.rmtree(run_directory, ignore_errors=True)
+    os.makedirs(run_directory)
+    shutil.copy(template, os.path.join(run_directory, "database.db"))
+    for name in ("price_levels.json", "coins.json"):
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), run_directory)
+    app_port, sink_port = getFreePort(), getFreePort()
+    sink = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "webhook_sink.py"),
+                             "--port", str(sink_port), "--latency", str(args.sink_latency)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    environment = dict(os.environ, PORT_TO_RUN_UVICORN=str(app_port), POLLING_ENABLED="False",
+                       DISCORD_API_BASE_URL=f"http://127.0.0.1:{sink_port}")
+    app = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=run_directory, env=environment,
+                           stdout=None if args.verbose else subprocess.DEVNULL,
+                           stderr=None if args.verbose else subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            await waitForServer(session, f"http://127.0.0.1:{sink_port}/stats", sink, 30)
+            await waitForServer(session, base_url + "/openapi.json", app, args.startup_timeout)
+            size_before = getDatabaseSize(run_directory)
+            ticks = list(generateTicks(args.symbols, args.ticks, args.seed, getLastPrices(template, args.symbols)))
+            time_start = time.perf_counter()
+            latencies = await replay(session, base_url, ticks, mode, args.batch_size, args.concurrency)
+            elapsed = time.perf_counter() - time_start
+            rss, peak_rss = getProcessMemory(app.pid)
+            # Let the aggregator and the write-behind buffer flush
+            await asyncio.sleep(args.settle)
+            async with session.get(f"http://127.0.0.1:{sink_port}/stats") as response:
+                sink_stats = await response.json()
+            alerts = await getAlertsTotal(session, base_url)
+    finally:
+        app.send_signal(signal.SIGINT)
+        try:
+            app.wait(30)
+        except subprocess.TimeoutExpired:
+            app.kill()
+        sink.terminate()
+        sink.wait()
+    return {
+        "mode": mode,
+        "ticks": len(ticks),
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "ticks_per_second": round(len(ticks) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "alerts": int(alerts),
+        "alerts_per_second": round(alerts / elapsed, 2),
+        "webhook_messages": sink_stats["received"],
+        "webhook_messages_per_second": round(sink_stats["received"] / (elapsed + args.settle), 2),
+        "rss_mb": round(rss, 1),
+        "peak_rss_mb": round(peak_rss, 1),
+        "db_growth_mb": round((getDatabaseSize(run_directory) - size_before) / 2 ** 20, 2),
+    }
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> bool:
+    ok = True
+    for mode, result in results.items():
+        if mode not in baseline:
+            continue
+        print(f"\n{mode} vs baseline")
+        for metric, higher_is_better in METRICS.items():
+            old, new = baseline[mode].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            regression = -change if higher_is_better else change
+            flag = ""
+            if metric in ("ticks_per_second", "p99_ms") and regression > max_regression:
+                flag = "  REGRESSION"
+                ok = False
+            print(f"  {metric:27} {old:>12} -> {new:>12} ({change:+.1f}%){flag}")
+    return ok
+
+
+async def main(args):
+    os.makedirs(args.dir, exist_ok=True)
+    template = os.path.join(args.dir, f"history_{args.symbols}x{args.days}d_{args.seed}.db")
+    if not os.path.exists(template):
+        random.seed(args.seed)
+        generateDatabase(template, args.symbols, args.days, args.interval)
+    modes = ["single", "bulk"] if args.mode == "both" else [args.mode]
+    results = {}
+    for mode in modes:
+        results[mode] = await runMode(args, template, mode)
+        print(json.dumps(results[mode], option=json.OPT_INDENT_2).decode())
+    if args.save_baseline:
+        with open(args.save_baseline, "wb") as file:
+            file.write(json.dumps(results, option=json.OPT_INDENT_2))
+    if args.baseline:
+        with open(args.baseline, "rb") as file:
+            if not compare(results, json.loads(file.read()), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest benchmark of the coordinator")
+    parser.add_argument("--dir", default="bench_ingest")
+    parser.add_argument("--symbols", type=int, default=200)
+    parser.add_argument("--days", type=int, default=1, help="days of prior history in the database")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between prior history ticks")
+    parser.add_argument("--ticks", type=int, default=20000, help="ticks to replay")
+    parser.add_argument("--mode", choices=["single", "bulk", "both"], default="both")
+    parser.add_argument("--batch-size", type=int, default=100, help="ticks per /addTokenPrices request")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--sink-latency", type=float, default=0.05, help="webhook sink response delay")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds to wait after the replay")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file, exit 1 on a regression")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="allowed %% drop of ticks/s or rise of p99 against the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the coordinator's output")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import aiohttp
+from bench_startup import ROOT
+from benchmark import getFreePort, waitForServer, generateTicks, replay
+
+# Checks that a sampling session of the /admin/profile routes collects stacks of the ingest requests:
+# main.py runs in its own process on an empty database, ticks are replayed through /addTokenPrices while a
+# session runs and the collapsed stacks it returns are counted. A sampler that only runs when the request
+# gives up the GIL lands on a handful of I/O points, hence the distinct stacks check.
+#   python tools/check_profiling.py --ticks 20000 --min-samples 100 --min-stacks 30
+
+ADMIN_TOKEN = "check-profiling"
+
+
+async def runCheck(args, directory: str) -> bool:
+    for name in ("price_levels.json", "coins.json"):
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), directory)
+    app_port, sink_port = getFreePort(), getFreePort()
+    sink = subprocess.Popen([sys.executable, os.path.join(ROOT, "tools", "webhook_sink.py"),
+                             "--port", str(sink_port), "--latency", "0"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    environment = dict(os.environ, PORT_TO_RUN_UVICORN=str(app_port), POLLING_ENABLED="False",
+                       ADMIN_TOKEN=ADMIN_TOKEN, DISCORD_API_BASE_URL=f"http://127.0.0.1:{sink_port}")
+    app = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=directory, env=environment,
+                           stdout=None if args.verbose else subprocess.DEVNULL,
+                           stderr=None if args.verbose else subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{app_port}"
+    headers = {"X-Admin-Token": ADMIN_TOKEN}
+    try:
+        async with aiohttp.ClientSession() as session:
+            await waitForServer(session, f"http://127.0.0.1:{sink_port}/stats", sink, 30)
+            await waitForServer(session, base_url + "/openapi.json", app, 60)
+            ticks = list(generateTicks(args.symbols, args.ticks, 1))
+            requests = (len(ticks) + args.batch_size - 1) // args.batch_size
+            async with session.post(base_url + "/admin/profile", headers=headers,
+                                    params={"mode": "sampling", "seconds": "300", "requests": str(requests),
+                                            "interval": str(args.interval)}) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"Could not start a profiling session: {await response.text()}")
+            await replay(session, base_url, ticks, "bulk", args.batch_size, 4)
+            async with session.get(base_url + "/admin/profile", headers=headers) as response:
+                text = await response.text()
+    finally:
+        app.send_signal(signal.SIGINT)
+        try:
+            app.wait(30)
+        except subprocess.TimeoutExpired:
+            app.kill()
+        sink.terminate()
+        sink.wait()
+    # "stack count" per line
+    stacks = [line.rsplit(" ", 1) for line in text.splitlines() if line]
+    samples = sum(int(count) for _, count in stacks)
+    ingest_samples = sum(int(count) for stack, count in stacks if "ingestTicks" in stack)
+    print(f"{samples} samples in {len(stacks)} distinct stacks, {ingest_samples} in ingestTicks")
+    for stack, count in sorted(stacks, key=lambda entry: -int(entry[1]))[:5]:
+        print(f"  {count:>6} {stack.rsplit(';', 3)[-3:]}")
+    return ingest_samples >= args.min_samples and len(stacks) >= args.min_stacks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that sampling profiles of ingest requests have stacks")
+    parser.add_argument("--symbols", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.001, help="sampling interval in seconds")
+    parser.add_argument("--min-samples", type=int, default=100, help="fail with fewer samples in ingestTicks")
+    parser.add_argument("--min-stacks", type=int, default=30, help="fail with fewer distinct stacks")
+    parser.add_argument("--verbose", action="store_true", help="show the coordinator's output")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        sys.exit(0 if asyncio.run(runCheck(args, directory)) else 1)
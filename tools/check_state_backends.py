@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state import MemoryStateBackend, RedisStateBackend
+
+# Runs the same checks against every state backend, comparing them to a brute force scan of the ticks:
+#   python tools/check_state_backends.py                      (memory + fakeredis)
+#   python tools/check_state_backends.py --redis-url redis://localhost:6379/15   (flushes that db!)
+
+RETENTION = 24 * 3600
+WINDOWS = [300, 900, 1800, 3600, 4 * 3600, 8 * 3600, 24 * 3600]
+
+
+def expectedNearest(ticks, ts):
+    best = None
+    for entry in sorted(ticks):
+        if best is None or abs(entry[0] - ts) < abs(best[0] - ts):
+            best = entry
+    return best
+
+
+def expectedWindows(ticks, windows, now_ts):
+    results = []
+    for window in windows:
+        prices = [price for ts, price in ticks if ts > now_ts - window]
+        results.append((expectedNearest(ticks, now_ts - window),
+                        max(prices) if prices else None, min(prices) if prices else None))
+    return results
+
+
+def generateTicks(seed: int, count: int, start_ts: int):
+    # Random walk with irregular gaps and a few out of order ticks. Timestamps are unique, which of several
+    # entries with the same ts a backend returns is not specified.
+    random.seed(seed)
+    ticks = []
+    seen = set()
+    ts = start_ts
+    price = random.uniform(0.01, 100)
+    for _ in range(count):
+        ts += random.choice([1, 7, 10, 10, 30, 61, 300])
+        price = round(price * (1 + random.gauss(0, 0.01)), 6)
+        tick_ts = ts - random.randint(1, 120) if random.random() < 0.03 else ts
+        if tick_ts in seen:
+            continue
+        seen.add(tick_ts)
+        ticks.append((tick_ts, price))
+    return ticks
+
+
+def checkBackend(name: str, backend, count: int):
+    failures = 0
+
+    def check(label, actual, expected):
+        nonlocal failures
+        if actual != expected:
+            failures += 1
+            if failures <= 10:
+                print(f"  {name}: {label}: got {actual}, expected {expected}")
+
+    start_ts = 1_700_000_000
+    check("empty last", backend.getLast("EMPTY"), None)
+    check("empty nearest", backend.getNearest("EMPTY", start_ts), None)
+    check("empty windows", backend.getWindows("EMPTY", [300], start_ts), [(None, None, None)])
+    for symbol_index in range(3):
+        symbol = f"SYM{symbol_index}"
+        ticks = generateTicks(symbol_index, count, start_ts)
+        newest_ts = 0
+        for step, (ts, price) in enumerate(ticks):
+            backend.addPrice(symbol, ts, price)
+            newest_ts = max(newest_ts, ts)
+            # What the backend has to keep: everything newer than retention before the newest tick
+            kept = [(tick_ts, tick_price) for tick_ts, tick_price in ticks[:step + 1]
+                    if tick_ts > newest_ts - RETENTION]
+            if step % 25 == 0 or step == len(ticks) - 1:
+                now_ts = newest_ts + random.randint(0, 90)
+                check(f"{symbol} windows at {now_ts}", backend.getWindows(symbol, WINDOWS, now_ts),
+                      expectedWindows(kept, WINDOWS, now_ts))
+                probe_ts = random.randint(kept[0][0] - 100, newest_ts + 100)
+                check(f"{symbol} nearest to {probe_ts}", backend.getNearest(symbol, probe_ts),
+                      expectedNearest(kept, probe_ts))
+                check(f"{symbol} last", backend.getLast(symbol), max(kept, key=lambda entry: entry[0]))
+    check("first level state", backend.swapLevelState("LEVELS", 1.5), (None, {}))
+    check("level state", backend.swapLevelState("LEVELS", 1.25), (1.5, {}))
+    check("enter level", backend.addInsideLevel("LEVELS", 1.2, "above"), True)
+    check("enter level again", backend.addInsideLevel("LEVELS", 1.2, "below"), False)
+    backend.addInsideLevel("LEVELS", 0.1, "below")
+    check("leave levels", backend.removeInsideLevels("LEVELS", [0.1, 0.5]), [0.1])
+    check("inside levels", backend.swapLevelState("LEVELS", 1.21), (1.25, {1.2: "above"}))
+    check("first claim", backend.claimAlert("alert:A", 2.0, start_ts, 300), True)
+    check("claim in cooldown", backend.claimAlert("alert:A", 2.0, start_ts + 10, 300), False)
+    check("more significant claim", backend.claimAlert("alert:A", 3.0, start_ts + 20, 300), True)
+    check("less significant claim", backend.claimAlert("alert:A", 1.0, start_ts + 30, 300), False)
+    check("other claim", backend.claimAlert("alert:B", 1.0, start_ts, 300), True)
+    print(f"{name}: {'OK' if failures == 0 else f'{failures} failed checks'}")
+    return failures == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Conformance checks for the state backends")
+    parser.add_argument("--redis-url", help="real Redis to check against instead of fakeredis, gets flushed")
+    parser.add_argument("--ticks", type=int, default=3000, help="ticks per symbol")
+    args = parser.parse_args()
+
+    backends = [("memory", MemoryStateBackend(RETENTION))]
+    if args.redis_url:
+        import redis
+        client = redis.from_url(args.redis_url)
+        client.flushdb()
+        backends.append(("redis", RedisStateBackend(client, RETENTION)))
+    else:
+        try:
+            import fakeredis
+            backends.append(("fakeredis", RedisStateBackend(fakeredis.FakeRedis(), RETENTION)))
+        except ImportError:
+            print("fakeredis is not installed, pass --redis-url to check the Redis backend")
+    results = [checkBackend(name, backend, args.ticks) for name, backend in backends]
+    sys.exit(0 if all(results) else 1)
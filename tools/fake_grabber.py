@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import random
+from collections import Counter
+from aiohttp import web
+
+# Local stand-in for a price grabber, speaks the same routes as the real one plus the bulk ones:
+#   python tools/fake_grabber.py --port 9100 --latency 0.05
+#   python tools/fake_grabber.py --port 9101 --no-bulk --fail-rate 0.1
+#   GRABBER_URLS=http://127.0.0.1:9100,http://127.0.0.1:9101 python main.py
+
+
+def createApp(latency: float = 0.0, fail_rate: float = 0.0, bulk: bool = True):
+    tokens = set()
+    received = Counter()
+
+    async def handle(request: web.Request):
+        received[f"{request.method} {request.match_info.route.resource.canonical.split('/')[1]}"] += 1
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        if fail_rate and random.random() < fail_rate:
+            return web.json_response({"response": "error"}, status=500)
+        return None
+
+    async def getTokens(request: web.Request):
+        return await handle(request) or web.json_response(sorted(tokens))
+
+    async def putToken(request: web.Request):
+        error = await handle(request)
+        if error is None:
+            tokens.add(request.match_info["symbol"])
+        return error or web.json_response({"response": "ok"})
+
+    async def deleteToken(request: web.Request):
+        error = await handle(request)
+        if error is None:
+            tokens.discard(request.match_info["symbol"])
+        return error or web.json_response({"response": "ok"})
+
+    async def putTokens(request: web.Request):
+        error = await handle(request)
+        if error is None:
+            tokens.update(str(symbol) for symbol in await request.json())
+        return error or web.json_response({"response": "ok"})
+
+    async def deleteTokens(request: web.Request):
+        error = await handle(request)
+        if error is None:
+            tokens.difference_update(str(symbol) for symbol in await request.json())
+        return error or web.json_response({"response": "ok"})
+
+    async def stats(_request: web.Request):
+        return web.json_response({"tokens": len(tokens), "requests": dict(received)})
+
+    app = web.Application()
+    app.router.add_get("/getTokens", getTokens)
+    app.router.add_put("/putToken/{symbol}", putToken)
+    app.router.add_delete("/deleteToken/{symbol}", deleteToken)
+    if bulk:
+        app.router.add_put("/putTokens", putTokens)
+        app.router.add_delete("/deleteTokens", deleteTokens)
+    app.router.add_get("/stats", stats)
+    app["tokens"] = tokens
+    app["received"] = received
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake price grabber")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.0, help="average response delay in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--no-bulk", action="store_true", help="only the per-symbol routes, like the real grabber")
+    args = parser.parse_args()
+    web.run_app(createApp(args.latency, args.fail_rate, not args.no_bulk), host=args.host, port=args.port)
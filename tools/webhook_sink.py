@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+# Local stand-in for Discord webhooks, for load testing notifications offline:
+#   python tools/webhook_sink.py --port 9000 --latency 0.2 --rate-limit 5
+#   DISCORD_API_BASE_URL=http://127.0.0.1:9000 python main.py
+
+
+def createApp(latency: float = 0.0, rate_limit: int = 0, window: float = 2.0):
+    received = Counter()
+    windows = {}
+    started = time.monotonic()
+
+    async def webhook(request: web.Request):
+        await request.post()
+        path = request.path
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        headers = {}
+        if rate_limit:
+            # Mimic Discord's per-webhook bucket
+            now = time.monotonic()
+            window_start, count = windows.get(path, (now, 0))
+            if now - window_start >= window:
+                window_start, count = now, 0
+            reset_after = window - (now - window_start)
+            if count >= rate_limit:
+                received["429"] += 1
+                return web.json_response({"message": "You are being rate limited.", "retry_after": reset_after},
+                                         status=429, headers={"Retry-After": f"{reset_after:.3f}"})
+            count += 1
+            windows[path] = (window_start, count)
+            headers = {"X-RateLimit-Limit": str(rate_limit), "X-RateLimit-Remaining": str(rate_limit - count),
+                       "X-RateLimit-Reset-After": f"{reset_after:.3f}"}
+        received[path] += 1
+        return web.Response(status=204, headers=headers)
+
+    async def stats(_request: web.Request):
+        elapsed = time.monotonic() - started
+        total = sum(count for path, count in received.items() if path != "429")
+        return web.json_response({"received": total, "per_second": total / elapsed if elapsed else 0.0,
+                                  "rate_limited": received["429"], "per_webhook": dict(received)})
+
+    app = web.Application()
+    app.router.add_get("/stats", stats)
+    app.router.add_post("/{tail:.*}", webhook)
+    app["received"] = received
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Discord webhook sink")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="average response delay in seconds")
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per webhook per window, 0 = unlimited")
+    parser.add_argument("--window", type=float, default=2.0, help="rate limit window in seconds")
+    args = parser.parse_args()
+    web.run_app(createApp(args.latency, args.rate_limit, args.window), host=args.host, port=args.port)